@@ -5,8 +5,6 @@ import logging
 from pathlib import Path
 from urllib.parse import quote_plus
 
-import requests
-
 import wd
 
 
@@ -15,10 +13,9 @@ class Element(wd.Article):
 
     @classmethod
     def get_cache(cls, reset=None) -> dict:
-        if (reset is None) and (Element.__cache is None):
-            query, o, Element.__cache = 'SELECT ?c ?i {{ ?i p:P819/ps:P819 ?c }} LIMIT 400000 OFFSET {}', -1, {}
-            while (o < len(Element.__cache)) and (r := wd.Wikidata.query(query.format(o := len(Element.__cache)))):
-                Element.__cache = Element.__cache | r
+        if (reset is None) and (Element.__cache is None):  # millions of bibcodes, so query is split from the start
+            sparql, Element.__cache = 'SELECT ?c ?i { ?i p:P819/ps:P819 ?c }', wd.QidMap()
+            wd.Wikidata.partitioned(sparql, parts=16, result=Element.__cache, ttl=Model.config('ttl', 'get_cache'))
         return super().get_cache(reset)
 
     def apply(self, parsed_data: Model):
@@ -28,31 +25,57 @@ class Element(wd.Article):
 
 
 class Model(wd.AstroModel):
-    property, db_ref, item, __offset, __ads = 'P819', 'Q752099', Element, 0, requests.session()
+    property, db_ref, item, __offset, __docs = 'P819', 'Q752099', Element, 0, {}
     URL = 'https://api.adsabs.harvard.edu/v1/search/query?q={}&fl={}'
-    __ads.headers.update({'Authorization': 'Bearer ' + (
+    BIGQUERY, BATCH = 'https://api.adsabs.harvard.edu/v1/search/bigquery?q=*:*&fl={}&rows={}', 2000
+    wd.Wikidata.session(URL).headers.update({'Authorization': 'Bearer ' + (
         __p.read_text().strip() if (__p := Path(__file__.replace('ads.py', '.ads'))).exists() else '')})
 
     @classmethod
+    @wd.Stats.timed('next')
     def next(cls):
-        cls._dataset = cls.load('oidbib BETWEEN {} AND {}'.format(cls.__offset, cls.__offset + 5000))
+        """Bibcodes of the next oidbib range, None if range cannot be loaded (checkpoint is kept to resume from it)"""
+        cls.__offset = cls.checkpoint(cls.__offset)
+        if (dataset := cls.load('oidbib BETWEEN {} AND {}'.format(cls.__offset, cls.__offset + 5000), False)) is None:
+            logging.error('Harvest interrupted at oidbib {}'.format(cls.__offset))
+            return
+        if not dataset:
+            cls.checkpoint(None)
+        cls._dataset = dataset
         cls.__offset = cls.__offset + 5000
         return cls._dataset.keys()
 
+    @staticmethod
+    def retrieve(bibcodes):
+        """Fetch documents of all bibcodes with a few bigquery requests, prepare_data() picks them up instead of
+        querying every bibcode separately. Documents retrieved by the previous call are discarded"""
+        bibcodes, fields, Model.__docs = list(bibcodes), quote_plus(','.join(Model.config('properties'))), {}
+        for batch in [bibcodes[i:i + Model.BATCH] for i in range(0, len(bibcodes), Model.BATCH)]:
+            data = 'bibcode\n' + '\n'.join(batch)
+            if response := wd.Wikidata.request(Model.BIGQUERY.format(fields, len(batch)), data=data,
+                                               headers={'Content-Type': 'big-query/csv'}):
+                try:
+                    for doc in response.json()['response']['docs']:
+                        for bibcode in {doc.get('bibcode'), *doc.get('identifier', [])}.intersection(batch):
+                            Model.__docs[bibcode] = doc  # requested bibcode might be an alternative one
+                except (ValueError, KeyError):
+                    logging.error('Cannot decode bigquery response for {} bibcodes'.format(len(batch)))
+
     @classmethod
     def prepare_data(cls, external_id):
-        if ((response := wd.Wikidata.request(Model.URL.format(quote_plus(external_id),
-                                                              quote_plus(','.join(Model.config('properties')))),
-                                             Model.__ads)) is None) or (len(response.json()['response']['docs']) == 0):
-            return
+        if (data := Model.__docs.pop(external_id, None)) is None:
+            url = Model.URL.format(quote_plus(external_id), quote_plus(','.join(Model.config('properties'))))
+            if ((response := wd.Wikidata.request(url)) is None) or not (docs := response.json()['response']['docs']):
+                return
+            data = docs[0]
 
         result = Model(external_id)
         result.input_snaks.append(Model.transform('P31', 'Q13442814'))
-
-        for idx in range(0, len((data := response.json()['response']['docs'][0])['author'])):
+        resolved = Element.resolve(('P496', orcid) for orcid in data['orcid_pub'] if orcid != '-')  # all at once
+        for idx in range(0, len(data['author'])):
             (snak := Model.transform('P2093', data['author'][idx]))['qualifiers'] = []
             try:
-                if author_id := Element.haswbstatement(data['orcid_pub'][idx], 'P496'):
+                if author_id := Element.haswbstatement(data['orcid_pub'][idx], 'P496', resolved):
                     (snak := Model.transform('P50', author_id))['qualifiers'] = [('P1932', data['author'][idx])]
             except ValueError as e:
                 logging.warning('Found {} authors with ORCID-ID {}'.format(e.args[0], data['orcid_pub'][idx]))
@@ -91,12 +114,17 @@ if Model.initialize(__file__):  # if not imported
     NO_ADS = 'SELECT ?c ?i {{VALUES ?c {{\'{}\'}} ?i p:P356/ps:P356 ?c FILTER NOT EXISTS {{?i p:P819 []}}}}'
     while bibcodes := Model.next():
         if wd_items := wd.Wikidata.query(NO_DOI.format('\' \''.join(bibcodes))):
-            for ex_id, qid in wd_items.items():
+            wd.Article.check_doi(Model._dataset[ex_id][0]['p356'] for ex_id in wd_items)  # empty ones are skipped
+            Model.retrieve(wd_items)
+            for ex_id in Model.pending(wd_items):
                 Model.get_by_id(ex_id, forced=True).save()
 
         doi = {}
         for ex_id in bibcodes:
-            doi[Model._dataset[ex_id][0]['p356'].upper()] = ex_id
+            if p356 := Model._dataset[ex_id][0]['p356']:
+                doi[p356.upper()] = ex_id
         if wd_items := wd.Wikidata.query(NO_ADS.format('\' \''.join(doi.keys()))):
-            for ex_id, qid in wd_items.items():
+            wd.Article.check_doi(wd_items)
+            Model.retrieve(doi[ex_id] for ex_id in wd_items)
+            for ex_id in Model.pending(wd_items, prefetch=False):
                 Model.get_by_id(doi[ex_id], forced=True).save()
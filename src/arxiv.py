@@ -1,13 +1,17 @@
 #!/usr/bin/python3
 from __future__ import annotations
 
-import http.client
+import itertools
 import logging
-import socket
-import time
-from urllib import request, error
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from xml.etree import ElementTree
 
+import requests
+import urllib3
+
 import wd
 
 
@@ -36,56 +40,144 @@ class Element(wd.Element):
 
 class Model(wd.Model):
     property, db_ref, item, chunk, suffix = 'P818', 'Q118398', Element, {}, 'metadataPrefix=arXiv'
+    __next, __pool = (None, None), ThreadPoolExecutor(1)  # (suffix, future) of the page downloaded in background
+    backoff = wd.Backoff()  # retry budget shared by all requests of the run
+    BATCH, __wanted, __fetched, __lock = 100, set(), {}, threading.Lock()  # ids per API request and prepared models
 
     def __init__(self, external_id: str, snaks: list = None):
         super().__init__(external_id, snaks)
         self.label, self.__doi = '', ''
 
     @staticmethod
-    def arxiv_xml(query: str) -> ElementTree:
-        for retries in range(5):
+    def fetch(query: str, stream: bool = False) -> requests.Response:
+        """Response of export.arxiv.org, None if server keeps failing or request is rejected as invalid"""
+        url = 'https://export.arxiv.org/' + query
+        for attempt in itertools.count():
+            retry_after = None
             try:
-                with request.urlopen((url := 'https://export.arxiv.org/' + query), timeout=180) as file:
-                    return ElementTree.fromstring(file.read())
-            except error.HTTPError as e:
-                if e.status == 503 and 'Retry-After' in e.headers:
-                    time.sleep(int(e.headers['Retry-After']))
-                    continue
-                logging.error('While fetching {} got error: {}'.format(url, e.__str__()))
-            except (http.client.IncompleteRead, ConnectionResetError, socket.timeout) as e:
+                if (response := wd.Wikidata.session(url).get(url, timeout=180, stream=stream)).status_code == 200:
+                    return response
+                logging.error('While fetching {} got error: {}'.format(url, response.status_code))
+                response.close()
+                if (retry_after := response.headers.get('Retry-After')) is None and \
+                        response.status_code not in wd.Backoff.TRANSIENT:
+                    return
+            except requests.exceptions.RequestException as e:
                 logging.error('While fetching {} got error: {}'.format(url, e.__str__()))
-            time.sleep(1800)
+            if not Model.backoff.wait(attempt, retry_after):
+                return
+            wd.Metrics.add('wdpy_http_retries_total', **wd.Metrics.labels(url))
+
+    @staticmethod
+    def arxiv_xml(query: str) -> ElementTree:
+        if response := Model.fetch(query):
+            return ElementTree.fromstring(response.content)
+
+    @staticmethod
+    def records(query: str):
+        """Parse ListRecords response while it is being received, yield (arXiv id, DOI) of every record with DOI and
+        finally (None, resumption token), nothing is yielded if download failed"""
+        ns, token, parser = Model.config('ns'), None, ElementTree.XMLPullParser()
+        if response := Model.fetch(query, stream=True):
+            with closing(response):
+                for chunk in response.iter_content(65536):  # received bytes are counted by Metrics
+                    parser.feed(chunk)
+                    for _, element in parser.read_events():
+                        if element.tag == '{' + ns['oa'] + '}arXiv':
+                            if (doi := element.find('oa:doi', ns)) is not None and doi.text:
+                                yield element.find('oa:id', ns).text, doi.text.split()[0].replace('\\', '').upper()
+                        elif element.tag == '{' + ns['oai'] + '}resumptionToken':
+                            token = element.text
+                        elif element.tag == '{' + ns['oai'] + '}record':
+                            element.clear()
+                parser.close()  # raises ParseError if response was truncated
+            yield None, token
+
+    @staticmethod
+    def page(suffix: str) -> tuple[dict, str]:
+        """({arXiv id: DOI}, resumption token or None for the last page) of ListRecords, None if download failed"""
+        for attempt in itertools.count():
+            chunk = {}
+            try:
+                for arxiv_id, doi in Model.records('oai2?verb=ListRecords&' + suffix):
+                    if arxiv_id is None:
+                        return chunk, doi
+                    chunk[arxiv_id] = doi
+                return
+            except (ElementTree.ParseError, urllib3.exceptions.HTTPError, requests.exceptions.RequestException) as e:
+                logging.error('While parsing {} got error: {}'.format(suffix, e.__str__()))
+                if not Model.backoff.wait(attempt):
+                    return
+
+    @staticmethod
+    def parse_entry(external_id: str, entry: ElementTree.Element) -> Model:
+        model, ns = Model(external_id), Model.config('ns')
+        model.input_snaks.append(model.transform('P31', 'Q13442814'))
+        model.label = ' '.join(entry.find('w3:title', ns).text.split())
+        model.input_snaks.append(model.transform('P1476', model.label))
+        author_num = 0
+        for author in entry.findall('w3:author/w3:name', ns):
+            if len(author.text.strip()) > 3:
+                snak = model.transform('P2093', author.text.strip())
+                snak['qualifiers'] = {'P1545': str(author_num := author_num + 1)}
+                model.input_snaks.append(snak)
+        if len(doi_list := entry.findall('arxiv:doi', ns)) == 1:
+            model.__doi = doi_list[0].text.upper()  # P356 is added by metadata() once DOI is validated
+        return model
+
+    @staticmethod
+    def metadata(arxiv_ids: list) -> dict:
+        """{arXiv id: Model} for all preprints found, retrieved with a single API request. DOIs of the whole batch are
+        validated in parallel, unregistered ones are not added"""
+        result, ns, requested = {}, Model.config('ns'), {re.sub('v\\d+$', '', _id): _id for _id in arxiv_ids}
+        query = 'api/query?max_results={}&id_list={}'.format(len(arxiv_ids), ','.join(arxiv_ids))
+        if (tree := Model.arxiv_xml(query)) is not None:
+            for entry in tree.findall('w3:entry', ns):
+                if (link := entry.find('w3:id', ns)) is not None and '/abs/' in link.text:
+                    arxiv_id = re.sub('v\\d+$', '', link.text.split('/abs/')[-1])
+                    arxiv_id = requested.get(arxiv_id, arxiv_id)
+                    result[arxiv_id] = Model.parse_entry(arxiv_id, entry)
+        registered = wd.Article.check_doi(model.__doi for model in result.values())
+        for model in result.values():
+            if model.__doi in registered:
+                model.input_snaks.append(model.transform('P356', model.__doi))
+        return result
+
+    @staticmethod
+    def want(arxiv_ids):
+        """Remember preprints that are not in wikidata yet, their metadata will be retrieved along with the next one"""
+        cache = Model.item.get_cache()
+        with Model.__lock:
+            Model.__wanted.update(_id for _id in arxiv_ids if _id not in Model.__fetched and _id not in cache)
 
     @classmethod
     def prepare_data(cls, external_id: str) -> []:
-        if tree := Model.arxiv_xml('api/query?id_list=' + external_id):
-            model = super().prepare_data(external_id)
-            model.input_snaks.append(model.transform('P31', 'Q13442814'))
-            model.label = ' '.join(tree.findall('*/w3:title', Model.config('ns'))[0].text.split())
-            model.input_snaks.append(model.transform('P1476', model.label))
-            author_num = 0
-            for author in tree.findall('*/*/w3:name', Model.config('ns')):
-                if len(author.text.strip()) > 3:
-                    snak = model.transform('P2093', author.text.strip())
-                    snak['qualifiers'] = {'P1545': str(author_num := author_num + 1)}
-                    model.input_snaks.append(snak)
-            if len(doi_list := tree.findall('*/arxiv:doi', Model.config('ns'))) == 1:
-                model.__doi = doi_list[0].text.upper()
-                model.input_snaks.append(model.transform('P356', model.__doi))
-            return model
+        with Model.__lock:
+            if external_id not in Model.__fetched:
+                others = (_id for _id in Model.__wanted if _id != external_id and _id not in Model.__fetched)
+                batch = [external_id] + list(itertools.islice(others, Model.BATCH - 1))
+                Model.__wanted.difference_update(batch)
+                if not (fetched := Model.metadata(batch)) and len(batch) > 1:  # malformed id fails the whole request
+                    fetched = Model.metadata([external_id])
+                Model.__fetched.update(fetched)
+            Model.__wanted.discard(external_id)
+            return Model.__fetched.pop(external_id, None)
 
     @classmethod  # -------------------- Arxiv Bulk Data Access part --------------------
+    @wd.Stats.timed('next')
     def next(cls):
-        cls.chunk = {}
-        if tree := cls.arxiv_xml('oai2?verb=ListRecords&' + cls.suffix):
-            for pp in tree.findall('.//oa:arXiv', Model.config('ns')):
-                if len(lst := pp.findall('oa:doi', Model.config('ns'))) > 0:
-                    doi = lst[0].text.split()[0].replace('\\', '').upper()
-                    Model.chunk[pp.find('oa:id', Model.config('ns')).text] = doi
-            if (element := tree.find('.//oai:resumptionToken', Model.config('ns'))) is not None and element.text:
-                cls.suffix = 'resumptionToken=' + element.text
-            else:
-                return None
+        """Return ids of the current page, while they are processed the next page is downloaded in background.
+        If the page cannot be downloaded harvest stops, keeping checkpoint to resume from it in the next run"""
+        cls.chunk, cls.suffix = {}, cls.checkpoint(cls.suffix)
+        suffix, future = Model.__next
+        if (page := future.result() if suffix == cls.suffix else Model.page(cls.suffix)) is None:
+            logging.error('Harvest interrupted at ' + cls.suffix)
+            return
+        cls.chunk, token = page
+        if not token:
+            return cls.checkpoint(None)
+        cls.suffix = 'resumptionToken=' + token
+        Model.__next = cls.suffix, Model.__pool.submit(Model.page, cls.suffix)
         return cls.chunk.keys()
 
     def get_qid(self):
@@ -105,6 +197,9 @@ if Model.initialize(__file__):  # if not imported
         for p818 in Model.chunk:
             if p356 := Model.chunk[p818]:
                 if no_doi_items and (qid := no_doi_items.pop(p818, 0)):  # DOI is absent
-                    wd.Claim.construct(wd.Wikidata.create_snak('P356', p356), qid).save(SUMMARY.format('P818', p818))
+                    wd.Claim.construct(wd.Wikidata.create_snak('P356', p356), qid).save_later(
+                        SUMMARY.format('P818', p818))
                 elif no_arxiv_items and (qid := no_arxiv_items.pop(p356, 0)):  # Arxiv is absent
-                    wd.Claim.construct(wd.Wikidata.create_snak('P818', p818), qid).save(SUMMARY.format('P356', p356))
+                    wd.Claim.construct(wd.Wikidata.create_snak('P818', p818), qid).save_later(
+                        SUMMARY.format('P356', p356))
+        wd.Claim.flush()
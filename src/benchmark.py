@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+"""Micro-benchmarks of performance-critical parts of wd.py, run as: python3 benchmark.py [--save] [name ...]
+Results are compared with the baseline saved by --save, so that slowdown is visible before weekly runs"""
+import json
+import os
+import random
+import sys
+import time
+import timeit
+import tracemalloc
+from unittest import mock
+
+from wd import Claim, Element, Model, QidMap, Wikidata
+
+BASELINE = os.path.join(Wikidata.STORAGE or os.path.dirname(os.path.abspath(__file__)), 'benchmark.json')
+TYPES = {'P50': 'wikibase-item', 'P248': 'wikibase-item', 'P1227': 'wikibase-item', 'P2241': 'wikibase-item',
+         'P1215': 'quantity', 'P2216': 'quantity', 'P577': 'time', 'P1545': 'string', 'P2093': 'string',
+         'P3083': 'external-id'}
+SOURCES = ['Q{}'.format(1000 + i) for i in range(100)]  # referenced publications, Q1000 is the database itself
+BANDS = ['Q{}'.format(2000 + i) for i in range(10)]
+VALUES = [('P1215', '5.12'), ('P2216', '-12.3', '0.5', '0.7'), ('P577', '2024-02-29'), ('P50', 'Q42'), ('P2093', 'A')]
+
+
+class Item(Element):
+    property_id, db_ref = 'P3083', SOURCES[0]
+
+
+class Source(Model):
+    property, db_ref, item = 'P3083', SOURCES[0], Item
+
+
+def measure(setup, action, repeat: int = 5) -> float:
+    """Minimal wall time of action(*setup()) in ms, setup is not measured"""
+    best = float('inf')
+    for _ in range(repeat):
+        args = setup()
+        started = time.perf_counter()
+        action(*args)
+        best = min(best, time.perf_counter() - started)
+    return 1000 * best
+
+
+def snak(property_id: str, value, qualifiers: list = None, sources: list = None) -> dict:
+    result = Wikidata.create_snak(property_id, *value) if isinstance(value, tuple) else Wikidata.create_snak(
+        property_id, value)
+    return {**result, 'qualifiers': qualifiers if qualifiers else [], 'source': sources if sources else []}
+
+
+def saved(item: Item, snaks: list) -> Item:
+    """Item with statements created from snaks as if they were already stored in wikidata"""
+    item._entity = {'id': item.qid, 'lastrevid': 1, 'labels': {}, 'claims': {}}
+    for s in snaks:
+        item.obtain_claim(s)
+    for statements in item.entity['claims'].values():
+        for statement in statements:
+            statement['mainsnak']['hash'] = 'h'
+            for ref in statement.get('references', []):
+                ref.pop('wdpy', None)
+    item._affected = set()
+    item.save_checkpoint()
+    return item
+
+
+def article(authors: int = 2000) -> tuple[Item, Source]:
+    """Item with `authors` referenced P2093 statements and parsed data mentioning the same authors"""
+    snaks = [snak('P2093', 'Author {}'.format(i), [('P1545', str(i + 1))]) for i in range(authors)]
+    return saved(Item('2024ApJ...1A', 'Q1'), snaks), Source('2024ApJ...1A', snaks)
+
+
+def star(values: int = 300) -> tuple[Item, Source]:
+    """Item with `values` multiply referenced P1215 (per band) and P2216 statements and parsed data confirming half"""
+    rnd = random.Random(0)
+    snaks = [snak('P1215', '{:.2f}'.format(rnd.uniform(0, 20)), [('P1227', rnd.choice(BANDS))], rnd.sample(SOURCES, 3))
+             for _ in range(values)]
+    snaks += [snak('P2216', ('{:.1f}'.format(rnd.uniform(-100, 100)), '0.5', '0.5'), [], rnd.sample(SOURCES, 3))
+              for _ in range(values)]
+    return saved(Item('HD 1', 'Q2'), snaks), Source('HD 1', snaks[::2])
+
+
+def references(count: int = 300) -> list:
+    rnd = random.Random(0)
+    return [{**Claim._create_ref(rnd.choice(SOURCES[:count // 3]), {'P2216': rnd.choice(SOURCES)}), 'wdpy': 1}
+            for _ in range(count)]
+
+
+def data_model() -> dict[str, float]:
+    """Hot paths of Element/Claim/Wikidata on synthetic items of realistic size, ms"""
+    with mock.patch('wd.Wikidata.type_of', TYPES.get), mock.patch('wd.Element._Element__cache', {}):
+        Claim._pub_dates.update({qid: 19900101 + 10000 * i for i, qid in enumerate(SOURCES)})
+        values = [Wikidata.create_value(*args) for args in VALUES]
+        return {
+            'obtain_claim 2000 authors': measure(article, lambda i, m: [i.obtain_claim(s) for s in m.input_snaks]),
+            'apply 2000 authors': measure(article, lambda i, m: i.apply(m)),
+            'apply 600 star values': measure(star, lambda i, m: i.apply(m)),
+            '_deduplicate 300 refs': measure(lambda: (references(),), lambda r: Claim._deduplicate(r, 'P2216')),
+            '_confirms 300 refs': measure(lambda: (references(),), lambda r: Claim._confirms(r, SOURCES[0])),
+            'deprecate_all_but_one 300': measure(star, lambda i, _: i.deprecate_all_but_one('P2216')),
+            'remove_all_but_one 300': measure(star, lambda i, _: i.remove_all_but_one('P1215', 'P1227')),
+            'remove_all_but_one 2000': measure(article, lambda i, _: i.remove_all_but_one('P2093', 'P1545')),
+            'serialize 2000 authors': measure(article, lambda i, _: (i._affected.add('P2093'), i.serialize())),
+            'was_modified 2000 authors': measure(article, lambda i, _: i.was_modified_since_checkpoint()),
+            'Wikidata.serialize 10k': measure(lambda: (values,), lambda v: [Wikidata.serialize(x) for x in v * 2000]),
+            'create_value 10k': measure(lambda: (), lambda: [Wikidata.create_value(*args) for args in VALUES * 2000]),
+        }
+
+
+def exoplanet_pages(planets: tuple = ('51_peg_b--12', 'kepler_338_d--1930', 'trappist_1_e--3376')) -> dict[str, float]:
+    """Parse time (ms) and peak memory (MB) per exoplanet.eu page: whole page vs REGIONS (with each installed parser),
+    pages are downloaded once, mismatches count pages where extracted fields differ from the whole page"""
+    import exoplanet_eu
+    from bs4.builder import builder_registry
+    url, result = 'https://exoplanet.eu/catalog/', {}
+    pages = [response.content for planet in planets if (response := Wikidata.request(url + planet))]
+    fields = [*exoplanet_eu.Model.config('planet'), *exoplanet_eu.Model.config('star')]
+
+    def extract(page):
+        values = [(ref.parent.findChild('span') or ref).text if (ref := page.find(id=f)) else None for f in fields]
+        return values + [str(page.select_one(s)) for s in ['#planet-detail-basic-info dd', '[id^=star-detail] dd',
+                                                            '[id=system-detail-basic-header]']] + [
+            p.get('id') for p in page.find_all('li', {'class': 'publication'})]
+
+    config = exoplanet_eu.Model.config
+    for parser in [name for name in ['html.parser', 'lxml'] if builder_registry.lookup(name)] if pages else []:
+        with mock.patch('exoplanet_eu.Model.config', lambda *k: parser if k == ('parser',) else config(*k)):
+            reference = [extract(exoplanet_eu.Model.parse(page, selective=False)) for page in pages]
+            for selective in [False, True]:
+                name = '{} {}'.format(parser, 'regions' if selective else 'whole')
+                result[name + ', ms'] = measure(lambda: (), lambda: [exoplanet_eu.Model.parse(page, selective)
+                                                                     for page in pages]) / len(pages)
+                tracemalloc.start()
+                parsed = [exoplanet_eu.Model.parse(page, selective) for page in pages]
+                result[name + ', MB'] = tracemalloc.get_traced_memory()[1] / 2 ** 20 / len(pages)
+                tracemalloc.stop()
+                result[name + ' mismatches'] = sum(extract(page) != ref for page, ref in zip(parsed, reference))
+    return result
+
+
+def qid_map(size: int = 1000000, lookups: int = 100000) -> dict[str, float]:
+    """Primary cache of `size` bibcode-like keys: plain dict vs QidMap (memory excludes key strings, shared by both)"""
+    rnd, result = random.Random(0), {}
+    raw = [('{}ApJ{:012d}'.format(rnd.randint(1900, 2024), rnd.randrange(10 ** 12)), rnd.randrange(1, 130000000))
+           for _ in range(size)]
+    keys = [key for key, _ in rnd.sample(raw, lookups)] + ['missing' + str(i) for i in range(lookups // 10)]
+    for container in [dict, QidMap]:
+        tracemalloc.start()
+        instance = container((key, 'Q' + str(qid)) for key, qid in raw)  # values are new strings, as in csv reader
+        result[container.__name__ + ' memory, MB'] = tracemalloc.get_traced_memory()[0] / 2 ** 20
+        tracemalloc.stop()
+        result[container.__name__ + ' build, s'] = timeit.timeit(
+            lambda: container((key, 'Q' + str(qid)) for key, qid in raw), number=1)
+        result[container.__name__ + ' lookup, us'] = 10 ** 6 * min(timeit.repeat(
+            lambda: [instance.get(key) for key in keys], number=1, repeat=3)) / len(keys)
+    return result
+
+
+if __name__ == '__main__':
+    try:
+        with open(BASELINE) as file:
+            baseline = json.load(file)
+    except (OSError, ValueError):
+        baseline = {}
+    results = {}
+    for suite in [data_model, exoplanet_pages, qid_map]:
+        if not (names := [arg for arg in sys.argv[1:] if not arg.startswith('--')]) or suite.__name__ in names:
+            for name, value in suite().items():
+                results[name] = value
+                change = '{:+.0%}'.format(value / baseline[name] - 1) if baseline.get(name) else ''
+                print('{:<30}{:>12.3f}{:>8}'.format(name, value, change))
+    if '--save' in sys.argv:
+        with open(BASELINE, 'w') as file:
+            json.dump({**baseline, **results}, file, indent=1)
@@ -25,8 +25,10 @@ class Element(wd.AstroItem):
             return (redirect[norm_id][0]['pl_name'] if norm_id in redirect else new[0]), new[1]
 
         if cls.__cache is None:
-            redirect = Model.query(Model.config('endpoint'), Model.config('redirects'))
-            cls.__cache = wd.Wikidata.query('SELECT ?id ?item {?item p:P5667/ps:P5667 ?id}', resolve_redirects)
+            redirect = Model.query(Model.config('endpoint'), Model.config('redirects'),
+                                   ttl=Model.config('ttl', 'queries'))
+            cls.__cache = wd.Wikidata.query('SELECT ?id ?item {?item p:P5667/ps:P5667 ?id}', resolve_redirects,
+                                            Model.config('ttl', 'get_cache'), wd.QidMap())
         return super().get_cache(reset)
 
 
@@ -34,8 +36,10 @@ class Model(wd.AstroModel):
     property, db_ref, __ids, item = 'P5667', 'Q5420639', None, Element
 
     @classmethod
+    @wd.Stats.timed('next')
     def next(cls):
-        cls._dataset = cls.load('P31 = \'CONFIRMED0\'') if not cls._dataset else {}
+        cls._dataset = (cls.load('P31 = \'CONFIRMED0\'') or {}) if not cls._dataset else {}
+        cls.prefetch_references(cls.references(row for rows in cls._dataset.values() for row in rows))
         return cls._dataset.keys()
 
     def process_column(self, row, col, new_col=None):
@@ -80,9 +84,10 @@ if Model.initialize(__file__):  # if not imported
     # Model.get_by_id('30 Ari B b', forced=True).save()  # uncomment to debug specific item only
     wd_items, ex_items = sorted(Model.item.get_cache().keys()), sorted(Model.next())  # Preload both
     logging.info('Start updating {} existing items'.format(len(wd_items)))
-    for ex_id in wd_items:
+    Model.prepare_parallel(wd_items)
+    for ex_id in Model.item.prefetch(wd_items):
         Model.get_by_id(ex_id, forced=True).save()
     logging.info('Finish updating existing items')
-    for ex_id in ex_items:
-        if ex_id not in Model.item.get_cache():  # not wd_items!
-            Model.get_by_id(ex_id, forced=True).save()
+    Model.prepare_parallel(ex_items := [i for i in ex_items if i not in Model.item.get_cache()])  # not wd_items!
+    for ex_id in Model.item.prefetch(ex_items):
+        Model.get_by_id(ex_id, forced=True).save()
@@ -3,10 +3,10 @@ from __future__ import annotations
 
 import logging
 import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from decimal import DecimalException
-
-import requests
-from bs4 import BeautifulSoup, element
+from bs4 import BeautifulSoup, SoupStrainer, element
 
 import wd
 
@@ -38,45 +38,98 @@ class Element(wd.AstroItem):
 
 
 class Model(wd.AstroModel):
-    property, __session, __offset, __page, __ids = 'P5653', None, 0, None, None
+    property, __offset, __pages, __ids = 'P5653', 0, {}, None
     db_ref, item = 'Q1385430', Element
     articles = {'publication_2540': 'Q54012702', 'publication_4966': 'Q66424531', 'publication_3182': 'Q56032677'}
+    REGIONS = SoupStrainer(attrs={'id': re.compile('^((planet|star|system)-detail|publication_)')})  # used parts
 
     def __init__(self, external_id: str, snaks: list = None):
         super().__init__(external_id, snaks)
-        self.external_id, self.label = external_id, ''
+        self.external_id, self.label, self.page = external_id, '', None
+
+    def __getstate__(self):
+        return {**self.__dict__, 'page': None}  # parsed page is not passed between processes
 
     @classmethod
+    @wd.Stats.timed('next')
     def next(cls):
-        if not Model.__session:
-            Model.__session = requests.Session()
-            wd.Wikidata.request('https://exoplanet.eu/catalog/', Model.__session)  # obtain csrftoken cookie
-            Model.__session.headers.update({'X-Csrftoken': Model.__session.cookies.get('csrftoken'),
-                                            'Referer': 'https://exoplanet.eu/catalog/'})
+        if 'X-Csrftoken' not in (session := wd.Wikidata.session('https://exoplanet.eu/catalog/')).headers:
+            wd.Wikidata.request('https://exoplanet.eu/catalog/')  # obtain csrftoken cookie
+            session.headers.update({'X-Csrftoken': session.cookies.get('csrftoken'),
+                                    'Referer': 'https://exoplanet.eu/catalog/'})
 
-        identifiers = []
+        identifiers, cls.__offset = [], cls.checkpoint(cls.__offset)
         params = {**{'iDisplayStart': cls.__offset}, **Model.config('post')}
-        if result := wd.Wikidata.request('https://exoplanet.eu/catalog/json/', Model.__session, data=params):
-            if (response := result.json()) and (cls.__offset < response['iTotalRecords']):
-                for record in response['aaData']:
-                    identifiers.append(re.findall('catalog/([^/]+)', record[0])[0])
+        if not (result := wd.Wikidata.request('https://exoplanet.eu/catalog/json/', data=params)):
+            logging.error('Harvest interrupted at {}'.format(cls.__offset))  # checkpoint is kept to resume from it
+            return
+        if cls.__offset < (response := result.json())['iTotalRecords']:
+            for record in response['aaData']:
+                identifiers.append(re.findall('catalog/([^/]+)', record[0])[0])
+        else:
+            cls.checkpoint(None)
         cls.__offset += len(identifiers)
         return identifiers
 
+    @staticmethod
+    def download(exoplanet_id):
+        """Final url (after redirects) and parsed page of the planet or None"""
+        if response := wd.Wikidata.request('https://exoplanet.eu/catalog/' + exoplanet_id):
+            return response.url, Model.parse(response.content)
+
+    @staticmethod
+    def parse(content, selective: bool = True) -> BeautifulSoup:
+        """Only REGIONS of the page are parsed, unless basic info or any of configured fields present in the page are
+        not there (i.e. page layout has changed). Parser can be switched to faster 'lxml' (if installed) in
+        exoplanet_eu.json"""
+        parser, fields = Model.config('parser') or 'html.parser', {*Model.config('planet'), *Model.config('star')}
+        if selective:
+            raw = content.encode() if isinstance(content, str) else content
+            fields = fields.intersection(i.decode() for i in re.findall(rb'\bid=["\']([^"\']+)', raw))
+            if (page := BeautifulSoup(content, parser, parse_only=Model.REGIONS)).find(id='planet-detail-basic-info'):
+                if not (skipped := fields - {tag['id'] for tag in page.find_all(id=fields.__contains__)}):
+                    return page
+                logging.warning('Fields {} are outside of parsed regions, whole page is parsed'.format(sorted(skipped)))
+        return BeautifulSoup(content, parser)
+
+    @staticmethod
+    def prefetch_pages(exoplanet_ids, ahead: int = 8):
+        """Yields exoplanet_ids while pages of up to `ahead` following ones are downloaded in background (no more than
+        Wikidata.CONNECTIONS in parallel). Page is kept for host star until the next id is requested"""
+        if Model.WORKERS > 1:  # pages are downloaded by prepare_parallel() workers
+            yield from exoplanet_ids
+            return
+        with ThreadPoolExecutor(wd.Wikidata.CONNECTIONS) as pool:
+            queue = deque()
+            for exoplanet_id in exoplanet_ids:
+                queue.append(exoplanet_id)
+                Model.__pages[exoplanet_id] = pool.submit(Model.download, exoplanet_id)
+                while len(queue) > ahead:
+                    yield queue[0]
+                    Model.__pages.pop(queue.popleft(), None)
+            while queue:
+                yield queue[0]
+                Model.__pages.pop(queue.popleft(), None)
+
+    @staticmethod
+    def page(exoplanet_id):
+        return future.result() if (future := Model.__pages.get(exoplanet_id)) else Model.download(exoplanet_id)
+
     @staticmethod
     def retrieve(exoplanet_id):
-        """Load page corresponding to self.external_id and update Exoplanet.articles with parsed sources"""
-        Model.__page = None
-        if response := wd.Wikidata.request(url := 'https://exoplanet.eu/catalog/' + exoplanet_id):
-            Model.__page = BeautifulSoup(response.content, 'html.parser')
-            for p in Model.__page.find_all('li', {'class': 'publication'}):
+        """Model with parsed page corresponding to exoplanet_id, Exoplanet.articles are updated with parsed sources"""
+        if downloaded := Model.page(exoplanet_id):
+            url, page = downloaded
+            wd.AstroModel.prefetch_references(a.get('href') for a in page.select('li.publication a'))
+            for p in page.find_all('li', {'class': 'publication'}):
                 try:
                     if p.get('id') not in Model.articles and (ref_id := Model.parse_publication(p)):
                         Model.articles[p.get('id')] = ref_id
                 except ValueError as e:
                     logging.info('{}\tFound {} results while looking for source {} by title'.
                                  format(url, e.args[0], p.get('id')))
-            return Model(response.url.removeprefix('https://exoplanet.eu/catalog/').removesuffix('/'))
+            (result := Model(url.removeprefix('https://exoplanet.eu/catalog/').removesuffix('/'))).page = page
+            return result
 
     @staticmethod
     def parse_publication(publication: element.Tag):
@@ -89,25 +142,28 @@ class Model(wd.AstroModel):
 
     @classmethod
     def prepare_data(cls, external_id, host_star: bool = False):
-        result = Model(external_id, []) if host_star else Model.retrieve(external_id)
-        if cls.__page:
+        if host_star and (downloaded := cls.page(external_id)):
+            (result := Model(external_id, [])).page = downloaded[1]
+        else:
+            result = None if host_star else cls.retrieve(external_id)
+        if result and (page := result.page):
             template = {'decorators': {'P12132': cls.db_ref}, 'source': [cls.db_ref]}
             if host_star:
                 template['decorators'][cls.property] = result.external_id
-                if star := cls.__page.select_one('[id^=star-detail] dd'):
+                if star := page.select_one('[id^=star-detail] dd'):
                     result.label = star.text.strip()
             else:
-                result.label = cls.__page.select_one('#planet-detail-basic-info dd').text.strip()
-                if star := cls.__page.select_one('[id^=star-detail] dd'):
+                result.label = page.select_one('#planet-detail-basic-info dd').text.strip()
+                if star := page.select_one('[id^=star-detail] dd'):
                     result.append_multiple('P397', [star.text.strip()], template)
-                elif cls.__page.select_one('[id=system-detail-basic-header]'):
+                elif page.select_one('[id=system-detail-basic-header]'):
                     result.input_snaks.append({'property': 'P397', 'datatype': 'wikibase-item', 'snaktype': 'novalue'})
 
             if result.label:
                 result.append_multiple('P528', [result.label], template)
 
             for div_id, property_id in cls.config('star' if host_star else 'planet').items():
-                if (ref := Model.__page.find(id=div_id)) and (text := ref.parent.findChild('span').text):
+                if (ref := page.find(id=div_id)) and (text := ref.parent.findChild('span').text):
                     template['source'] = cls.parse_ref(ref)
                     if property_id in ['P397', 'P528']:
                         result.append_multiple(property_id, text.split(','), template)
@@ -188,10 +244,11 @@ if Model.initialize(__file__):  # if just imported - do nothing
     updated_hosts = []
     # process('51_peg_b--12')  # uncomment to debug specific item only
     logging.info('Start updating {} existing items'.format(len(Model.item.get_cache())))
-    for ex_id in sorted(Model.item.get_cache().keys()):
+    Model.prepare_parallel(existing := sorted(Model.item.get_cache().keys()))
+    for ex_id in Model.prefetch_pages(Model.item.prefetch(existing)):
         process(ex_id)
     logging.info('Finish updating existing items')
     while chunk := Model.next():
-        for ex_id in sorted(chunk):
-            if ex_id not in Model.item.get_cache():
-                process(ex_id)
+        Model.prepare_parallel(chunk := [i for i in sorted(chunk) if i not in Model.item.get_cache()])
+        for ex_id in Model.pending(Model.prefetch_pages(chunk), prefetch=False):
+            process(ex_id)
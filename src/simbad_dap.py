@@ -1,5 +1,7 @@
 #!/usr/bin/python3
+import logging
 import math
+from concurrent.futures import ThreadPoolExecutor
 
 import wd
 
@@ -10,10 +12,37 @@ class Element(wd.AstroItem):
 
 class Model(wd.AstroModel):
     property, db_ref, item, __offset, __var_types, _ADQL_WRAPPER = 'P3083', 'Q654724', Element, 0, None, '{} WHERE {}'
+    AHEAD, __ranges, __loader = 2, {}, None  # number of oid ranges loaded in background, {offset: future}
 
     @classmethod
+    def load_range(cls, offset: int) -> dict:
+        """Objects of the range starting from offset, while following AHEAD ranges are being loaded in background"""
+        if Model.WORKERS > 1:  # prepare_parallel() should not fork while TAP queries are running in other threads
+            return cls.load('oid BETWEEN {} AND {}'.format(offset, offset + 10000), False)
+        Model.__loader = Model.__loader or ThreadPoolExecutor(Model.AHEAD + 1)
+        for following in range(offset, offset + 10000 * (Model.AHEAD + 1), 10000):
+            if following not in Model.__ranges:
+                condition = 'oid BETWEEN {} AND {}'.format(following, following + 10000)
+                Model.__ranges[following] = Model.__loader.submit(cls.load, condition, False)
+        for stale in [key for key in Model.__ranges if key < offset]:  # position was changed by checkpoint
+            Model.__ranges.pop(stale).cancel()
+        return Model.__ranges.pop(offset).result()
+
+    @classmethod
+    @wd.Stats.timed('next')
     def next(cls):
-        cls._dataset = cls.load('oid BETWEEN {} AND {}'.format(cls.__offset, cls.__offset + 10000))
+        """Objects of the next oid range, None if range cannot be loaded (checkpoint is kept to resume from it)"""
+        cls.__offset = cls.checkpoint(cls.__offset)
+        if not (dataset := cls.load_range(cls.__offset)):
+            for future in Model.__ranges.values():
+                future.cancel()
+            Model.__ranges = {}
+            if dataset is None:
+                logging.error('Harvest interrupted at oid {}'.format(cls.__offset))
+                return
+            cls.checkpoint(None)
+        cls._dataset = dataset
+        cls.prefetch_references(cls.references(row for rows in dataset.values() for row in rows))
         cls.__offset = cls.__offset + 10000
         return cls._dataset.keys()
 
@@ -56,5 +85,6 @@ class Model(wd.AstroModel):
 if Model.initialize(__file__):  # if not imported
     # Model.get_by_id('* 51 Eri b', forced=True)
     while chunk := Model.next():
-        for ex_id in sorted(chunk):
+        Model.prepare_parallel(sorted(chunk))
+        for ex_id in Model.pending(sorted(chunk)):
             Model.get_by_id(ex_id, forced=True).save()
@@ -1,18 +1,18 @@
 #!/usr/bin/python3
-from sys import argv
+from sys import argv, exit
 
 from wd import Wikidata, Claim, AstroModel
 
 ADQL = 'SELECT id, main_id from ident JOIN basic ON oidref = oid AND main_id != id AND id IN (\'{}\')'
 Wikidata.logon(argv[1], argv[2])
-offset = -(size := 10000)
-while (offset := offset + size) >= 0:
-    if chunk := Wikidata.query('SELECT ?i ?s {{?s ps:P3083 ?i}} LIMIT {} OFFSET {}'.format(size, offset)):
-        if redirect := AstroModel.query('https://simbad.u-strasbg.fr/simbad/sim-tap',
-                                        ADQL.format('\',\''.join([i.replace('\'', '\'\'') for i in chunk.keys()]))):
-            for old_id in redirect:
-                if ((new_id := redirect[old_id][0]['main_id']) != old_id) and (old_id in chunk):
-                    statement_id = chunk[old_id].replace('-', '$', 1).replace('statement/', '')
-                    Claim.construct(Wikidata.create_snak('P3083', new_id), statement_id).save('was ' + old_id)
-    elif chunk is not None and len(chunk) == 0:
-        break
+if (statements := Wikidata.partitioned('SELECT ?i ?s {?item p:P3083 ?s. ?s ps:P3083 ?i}', '?item', parts=4)) is None:
+    exit(1)
+ids = list(statements)  # 10000 ids per TAP query
+for chunk in (ids[offset:offset + 10000] for offset in range(0, len(ids), 10000)):
+    if redirect := AstroModel.query('https://simbad.u-strasbg.fr/simbad/sim-tap',
+                                    ADQL.format('\',\''.join([i.replace('\'', '\'\'') for i in chunk]))):
+        for old_id in redirect:
+            if ((new_id := redirect[old_id][0]['main_id']) != old_id) and (old_id in statements):
+                statement_id = statements[old_id].replace('-', '$', 1).replace('statement/', '')
+                Claim.construct(Wikidata.create_snak('P3083', new_id), statement_id).save_later('was ' + old_id)
+        Claim.flush()
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+"""Local stand-in for Wikibase API, WDQS and TAP endpoints to measure bot throughput without touching production.
+Run as: python3 stand_in.py [--port 8000] [--entities entities.json] [--types property_types.json] [--tap rows.csv]
+[--latency 0.05] [--maxlag 0.01] [--errors 0.001] and start the bot with environment variable
+WDPY_SERVER=http://localhost:8000"""
+import argparse
+import csv
+import io
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class Store:
+    """In-memory entities addressed by qid, with minimal subset of wbeditentity/wbsetclaim semantics"""
+
+    def __init__(self, entities: dict = None):
+        self.entities, self.revision, self.lock = entities if entities else {}, 1, threading.Lock()
+        self.next = max([int(qid[1:]) for qid in self.entities], default=0) + 1
+
+    def get(self, ids: list[str]) -> dict:
+        with self.lock:
+            return {qid: json.loads(json.dumps(self.entities[qid])) if qid in self.entities else {
+                'id': qid, 'missing': ''} for qid in ids}
+
+    def __commit(self, entity: dict):
+        self.revision += 1
+        entity['lastrevid'] = self.revision
+        self.entities[entity['id']] = entity
+
+    @staticmethod
+    def __set_claim(entity: dict, claim: dict):
+        claim['id'] = claim['id'] if 'id' in claim else entity['id'] + '$' + str(uuid.uuid4())
+        statements = entity['claims'].setdefault(property_id := claim['mainsnak']['property'], [])
+        entity['claims'][property_id] = [s for s in statements if s.get('id') != claim['id']]
+        if 'remove' not in claim:
+            entity['claims'][property_id].append(claim)
+
+    def edit(self, qid: str, data: dict) -> dict:
+        with self.lock:
+            if qid is None:
+                qid, self.next = 'Q' + str(self.next), self.next + 1
+            entity = json.loads(json.dumps(self.entities.get(qid, {'id': qid, 'type': 'item', 'claims': {}})))
+            claims = data.get('claims', [])
+            for claim in [c for p in claims for c in claims[p]] if isinstance(claims, dict) else claims:
+                self.__set_claim(entity, claim)
+            for section in ['labels', 'descriptions', 'aliases']:
+                if section in data:
+                    entity[section] = {**entity.get(section, {}), **data[section]}
+            self.__commit(entity)
+            return entity
+
+    def set_claim(self, claim: dict) -> dict:
+        with self.lock:
+            if (qid := claim.get('id', '').split('$')[0].upper()) not in self.entities:
+                return None
+            self.__set_claim(entity := self.entities[qid], claim)
+            self.__commit(entity)
+            return entity
+
+    def find(self, property_id: str, value: str = None):
+        """(value, qid) of all string-like statements of the property"""
+        with self.lock:
+            for qid, entity in self.entities.items():
+                for statement in entity.get('claims', {}).get(property_id, []):
+                    if isinstance(v := statement['mainsnak'].get('datavalue', {}).get('value'), dict):
+                        v = v.get('id')
+                    if v is not None and value in [None, v]:
+                        yield v, qid
+
+
+class Handler(BaseHTTPRequestHandler):
+    store, types, tap, latency, maxlag, errors, stats = Store(), {}, '', 0.0, 0.0, 0.0, Counter()
+    protocol_version, ENTITY = 'HTTP/1.1', 'http://www.wikidata.org/entity/'
+    ONTOLOGY, TYPES = 'http://wikiba.se/ontology#', {'wikibase-item': 'WikibaseItem', 'external-id': 'ExternalId'}
+
+    def log_message(self, *_):
+        pass
+
+    def do_GET(self):
+        self.dispatch(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        self.dispatch(parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()))
+
+    def reply(self, body: str, content_type: str = 'application/json', code: int = 200, headers: dict = None):
+        self.send_response(code)
+        for key, value in {'Content-Type': content_type, 'Content-Length': len(data := body.encode()),
+                           **(headers if headers else {})}.items():
+            self.send_header(key, str(value))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def dispatch(self, params: dict):
+        params = {key: values[0] for key, values in params.items()}
+        Handler.stats[action := params.get('action', urlparse(self.path).path.rsplit('/', 1)[-1])] += 1
+        time.sleep(Handler.latency)
+        if random.random() < Handler.errors:
+            Handler.stats['injected errors'] += 1
+            return self.reply('Internal Server Error', 'text/plain', 500)
+        if action in ['wbeditentity', 'wbsetclaim'] and random.random() < Handler.maxlag:
+            Handler.stats['injected maxlag'] += 1
+            return self.reply(json.dumps({'error': {'code': 'maxlag', 'info': 'Waiting for all: 5 seconds lagged'}}),
+                              headers={'Retry-After': '1'})
+        if (path := urlparse(self.path).path).endswith('/sparql'):
+            return self.reply(self.sparql(params.get('query', '')), 'text/csv')
+        if path.endswith('/sync'):
+            return self.reply(self.adql(params.get('query', '')), 'text/csv')
+        if path.endswith('/api.php'):
+            return self.reply(json.dumps(self.api(action, params)))
+        self.reply('Not Found', 'text/plain', 404)
+
+    @staticmethod
+    def api(action: str, params: dict) -> dict:
+        if action == 'query' and params.get('meta') == 'tokens':
+            return {'query': {'tokens': {'logintoken': 'login+\\', 'csrftoken': 'csrf+\\'}}}
+        if action == 'query' and params.get('list') == 'search':
+            if found := re.fullmatch('haswbstatement:"(P\\d+)=(.+)"', params.get('srsearch', '')):
+                return {'query': {'search': [{'title': qid} for _, qid in Handler.store.find(*found.groups())]}}
+            return {'query': {'search': []}}
+        if action == 'login':
+            return {'login': {'result': 'Success', 'lgusername': params.get('lgname')}}
+        if action == 'wbgetentities':
+            return {'entities': Handler.store.get(params.get('ids', '').split('|')), 'success': 1}
+        if action == 'wbeditentity':
+            if 'id' in params and params['id'] not in Handler.store.entities:
+                return {'error': {'code': 'no-such-entity', 'info': 'Could not find entity ' + params['id']}}
+            entity = Handler.store.edit(params.get('id'), json.loads(params.get('data', '{}')))
+            return {'entity': entity, 'success': 1}
+        if action == 'wbsetclaim':
+            if (entity := Handler.store.set_claim(json.loads(params.get('claim', '{}')))) is None:
+                return {'error': {'code': 'invalid-guid', 'info': 'Invalid claim guid'}}
+            return {'pageinfo': {'lastrevid': entity['lastrevid']}, 'success': 1}
+        return {'error': {'code': 'badvalue', 'info': 'Unsupported action ' + action}}
+
+    @staticmethod
+    def sparql(query: str) -> str:
+        """Only query shapes used by wd.py are understood: property types, VALUES lookup of external ids and (value,
+        item) pairs of a single property (optionally within range of item ids), everything else returns empty result"""
+        header = re.search('SELECT\\s+(?:DISTINCT\\s+)?((?:\\?\\w+\\s*)*)', query)
+        rows = [re.findall('\\?(\\w+)', header.group(1)) if header else []]
+        if found := re.search('\\?prop wikibase:propertyType \\?type .*> (\\d+)', query, re.S):
+            for property_id, name in Handler.types.items():
+                if int(property_id[1:]) > int(found.group(1)):
+                    name = Handler.TYPES.get(name, name.capitalize())
+                    rows.append([Handler.ENTITY + property_id, Handler.ONTOLOGY + name])
+        elif values := re.search('VALUES \\(\\?p \\?c\\) {(.*?)}', query, re.S):
+            for property_id, value in re.findall('\\(wd:(P\\d+) ("(?:[^"\\\\]|\\\\.)*")\\)', values.group(1)):
+                for v, qid in Handler.store.find(property_id, json.loads(value)):
+                    rows.append([Handler.ENTITY + property_id, v, Handler.ENTITY + qid])
+        elif found := re.fullmatch('SELECT \\?c \\?i {\\s*\\?i p:(P\\d+)/ps:\\1 \\?c\\s*' +
+                                   '(?:FILTER\\(.* >= (\\d+) .* < (\\d+)\\))?\\s*}', query.strip(), re.S):
+            low, high = int(found.group(2) or 0), int(found.group(3) or 2 ** 31)
+            rows += [[v, Handler.ENTITY + qid] for v, qid in Handler.store.find(found.group(1))
+                     if low <= int(qid[1:]) < high]
+        return Handler.table(rows)
+
+    @staticmethod
+    def adql(query: str) -> str:
+        """Rows of --tap fixture satisfying `column BETWEEN low AND high` and `column = 'value'` conditions of the last
+        WHERE clause (condition on a column absent in the fixture matches nothing), header is sent in any case"""
+        rows = list(csv.reader(io.StringIO(Handler.tap))) or [['main_id']]
+        index, condition = {name.lower(): i for i, name in enumerate(rows[0])}, ''.join(query.rsplit(' WHERE ', 1)[1:])
+        for column, low, high in re.findall('(\\w+) BETWEEN (\\d+) AND (\\d+)', condition, re.I):
+            i = index.get(column.lower())
+            rows[1:] = [r for r in rows[1:] if i is not None and r[i].isdigit() and int(low) <= int(r[i]) <= int(high)]
+        for column, value in re.findall("(\\w+)\\s*=\\s*'((?:[^']|'')*)'", condition):
+            i = index.get(column.lower())
+            rows[1:] = [r for r in rows[1:] if i is not None and r[i] == value.replace("''", "'")]
+        return Handler.table(rows)
+
+    @staticmethod
+    def table(rows: list) -> str:
+        """CSV as sent by WDQS and TAP"""
+        return '\r\n'.join(','.join('"' + cell.replace('"', '""') + '"' for cell in row) for row in rows) + '\r\n'
+
+
+def serve(port: int = 8000) -> ThreadingHTTPServer:
+    """Start server in background thread, port 0 picks any free one (see server.server_port)"""
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--entities', help='json file with {qid: entity} to start with')
+    parser.add_argument('--types', help='json file with {pid: type} or property_types.json snapshot of WDPY_STORAGE')
+    parser.add_argument('--tap', help='csv file with rows returned by TAP queries (filtered by oid range or main_id)')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--maxlag', type=float, default=0.0, help='share of edits rejected with maxlag error')
+    parser.add_argument('--errors', type=float, default=0.0, help='share of requests failed with HTTP 500')
+    args = parser.parse_args()
+    if args.entities:
+        with open(args.entities) as file:
+            Handler.store = Store(json.load(file))
+    if args.types:
+        with open(args.types) as file:
+            types = json.load(file)
+        Handler.types = {p: types['types'][code] for p, code in types['codes'].items()} if 'codes' in types else types
+    if args.tap:
+        with open(args.tap, encoding='utf-8') as file:
+            Handler.tap = file.read()
+    Handler.latency, Handler.maxlag, Handler.errors = args.latency, args.maxlag, args.errors
+    started, instance = time.time(), serve(args.port)
+    logging.basicConfig(format="%(asctime)s: %(levelname)s - %(message)s", level=logging.INFO)
+    logging.info('Listening on http://localhost:{}'.format(instance.server_port))
+    try:
+        while True:
+            time.sleep(60)
+            logging.info('{:.1f} edits/min, {}'.format(
+                60 * (Handler.stats['wbeditentity'] + Handler.stats['wbsetclaim']) / (time.time() - started),
+                dict(Handler.stats)))
+    except KeyboardInterrupt:
+        instance.shutdown()
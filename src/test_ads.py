@@ -0,0 +1,24 @@
+from unittest import TestCase, mock
+from unittest.mock import MagicMock
+
+from ads import Model
+
+DOC = {'bibcode': '2024AJ....167..238O', 'identifier': ['2023arXiv231100001O', 'arXiv:2311.00001'],
+       'author': ['Author, A.'], 'orcid_pub': ['-']}
+
+
+@mock.patch('ads.Model._Model__docs', new_callable=dict)
+@mock.patch('ads.Element.haswbstatement', return_value=None)
+@mock.patch('ads.Element.resolve')
+@mock.patch('wd.Wikidata.type_of', return_value='string')
+class TestRetrieve(TestCase):
+    @mock.patch('wd.Wikidata.request', return_value=MagicMock(json=lambda: {'response': {'docs': [DOC]}}))
+    def test_batch(self, request, *_):
+        Model.retrieve(['2023arXiv231100001O', '2024AJ....167..999X'])
+        self.assertEqual('bibcode\n2023arXiv231100001O\n2024AJ....167..999X', request.call_args.kwargs['data'])
+        self.assertIn('/bigquery?', request.call_args.args[0])
+        request.return_value = None
+        self.assertIn('P818', [snak['property'] for snak in Model.prepare_data('2023arXiv231100001O').input_snaks])
+        self.assertEqual(1, request.call_count)  # document was already retrieved
+        self.assertIsNone(Model.prepare_data('2024AJ....167..999X'))  # not found, falls back to single query
+        self.assertEqual(2, request.call_count)
@@ -1,4 +1,5 @@
 from unittest import TestCase, mock
+from unittest.mock import MagicMock
 
 from wd import Article, Wikidata
 
@@ -18,3 +19,36 @@ class TestPostProcess(TestCase):
         self.assertIn('remove', item._queue[1])
         self.assertDictEqual(claim1, item._queue[2])
         self.assertDictEqual(claim2, item._queue[3])
+
+
+class TestCheckDoi(TestCase):
+    def setUp(self):
+        Article._dois = {}
+
+    @mock.patch('wd.Wikidata.session')
+    def test_cached(self, session):
+        session.return_value.get.side_effect = lambda url, timeout: MagicMock(status_code=404 if 'BAD' in url else 200)
+        self.assertEqual({'10.1/GOOD'}, Article.check_doi(['10.1/good', '10.1/bad']))
+        self.assertEqual(2, session.return_value.get.call_count)
+        self.assertEqual({'10.1/GOOD'}, Article.check_doi(['10.1/good', '10.1/bad']))
+        self.assertEqual(2, session.return_value.get.call_count)
+
+    @mock.patch('wd.Wikidata.session')
+    def test_expired(self, session):
+        session.return_value.get.return_value = MagicMock(status_code=200)
+        Article._dois = {'10.1/A': (False, 0)}
+        self.assertEqual({'10.1/A'}, Article.check_doi(['10.1/a']))
+
+    @mock.patch('wd.Wikidata.session')
+    def test_unknown_not_cached(self, session):
+        session.return_value.get.return_value = MagicMock(status_code=500)
+        self.assertEqual(set(), Article.check_doi(['10.1/a']))
+        self.assertNotIn('10.1/A', Article._dois)
+
+    @mock.patch('wd.ThreadPoolExecutor')
+    @mock.patch('wd.Wikidata.session')
+    def test_single(self, session, executor):
+        session.return_value.get.return_value = MagicMock(status_code=200)
+        self.assertEqual({'10.1/A'}, Article.check_doi(['10.1/a', '', None]))
+        session.return_value.get.assert_called_once_with('https://doi.org/api/handles/10.1/A', timeout=Wikidata.TIMEOUT)
+        executor.assert_not_called()
@@ -0,0 +1,94 @@
+from xml.etree import ElementTree
+from unittest import TestCase, mock
+from unittest.mock import MagicMock
+
+import requests
+
+from arxiv import Model
+
+PAGE = '''<?xml version="1.0" encoding="UTF-8"?>
+<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListRecords>
+<record><metadata><arXiv xmlns="http://arxiv.org/OAI/arXiv/"><id>0704.0001</id><doi>10.1103/physrevd.76.013009 
+</doi></arXiv></metadata></record>
+<record><metadata><arXiv xmlns="http://arxiv.org/OAI/arXiv/"><id>0704.0002</id></arXiv></metadata></record>
+<resumptionToken cursor="0">{}</resumptionToken></ListRecords></OAI-PMH>'''
+
+FEED = '''<feed xmlns="http://www.w3.org/2005/Atom" xmlns:arxiv="http://arxiv.org/schemas/atom"><title>query</title>
+<entry><id>http://arxiv.org/abs/2110.15392v2</id><title>First\n  preprint</title><author><name>A. Author</name></author>
+<author><name>B. Author</name></author><arxiv:doi>10.1/a</arxiv:doi></entry>
+<entry><id>http://arxiv.org/abs/gr-qc/0204022v1</id><title>Second</title><author><name>C. Author</name></author></entry>
+</feed>'''
+
+
+def response(token: str = '', size: int = None) -> MagicMock:
+    content = PAGE.format(token).encode()[:size]
+    return MagicMock(iter_content=lambda chunk: (content[i:i + 100] for i in range(0, len(content), 100)))
+
+
+class TestListRecords(TestCase):
+    @mock.patch('arxiv.Model.fetch', return_value=response('6960524|1001'))
+    def test_records(self, _):
+        self.assertEqual([('0704.0001', '10.1103/PHYSREVD.76.013009'), (None, '6960524|1001')],
+                         list(Model.records('oai2?verb=ListRecords&metadataPrefix=arXiv')))
+
+    @mock.patch('wd.Backoff.wait', return_value=False)
+    @mock.patch('arxiv.Model.fetch', return_value=response(size=300))
+    def test_truncated(self, _, wait):
+        self.assertIsNone(Model.page('metadataPrefix=arXiv'))
+        wait.assert_called_once_with(0)
+
+    @mock.patch('arxiv.Model.suffix', 'metadataPrefix=arXiv')
+    @mock.patch('arxiv.Model.checkpoint', side_effect=lambda cursor: cursor)
+    @mock.patch('arxiv.Model.fetch', side_effect=[response('6960524|1001'), response()])
+    def test_next(self, fetch, _):
+        self.assertEqual(['0704.0001'], list(Model.next()))
+        self.assertEqual('resumptionToken=6960524|1001', Model.suffix)
+        self.assertIsNone(Model.next())  # last page was already downloaded in background
+        self.assertEqual(2, fetch.call_count)
+
+    @mock.patch('wd.Backoff.wait', return_value=True)
+    @mock.patch('wd.Wikidata.session')
+    def test_fetch_retries(self, session, wait):
+        session.return_value.get.side_effect = [requests.exceptions.ConnectionError(),
+                                                MagicMock(status_code=503, headers={'Retry-After': '5'}),
+                                                MagicMock(status_code=200)]
+        self.assertEqual(200, Model.fetch('api/query?id_list=0704.0001').status_code)
+        self.assertEqual([mock.call(0, None), mock.call(1, '5')], wait.call_args_list)
+
+    @mock.patch('wd.Backoff.wait', return_value=True)
+    @mock.patch('wd.Wikidata.session')
+    def test_fetch_rejected(self, session, wait):
+        session.return_value.get.return_value = MagicMock(status_code=400, headers={})
+        self.assertIsNone(Model.fetch('oai2?verb=ListRecords&resumptionToken=bad'))
+        wait.assert_not_called()
+
+
+@mock.patch('arxiv.Model._Model__fetched', new_callable=dict)
+@mock.patch('arxiv.Model._Model__wanted', new_callable=set)
+@mock.patch('wd.Wikidata.type_of', return_value='string')
+@mock.patch('wd.Article.check_doi', side_effect=lambda dois: set(dois))
+class TestMetadata(TestCase):
+    @mock.patch('arxiv.Element.get_cache', return_value={'1001.00001': 'Q1'})
+    @mock.patch('arxiv.Model.arxiv_xml', return_value=ElementTree.fromstring(FEED))
+    def test_batch(self, arxiv_xml, *_):
+        Model.want(['gr-qc/0204022', '1001.00001'])
+        model = Model.prepare_data('2110.15392')
+        arxiv_xml.assert_called_once_with('api/query?max_results=2&id_list=2110.15392,gr-qc/0204022')
+        self.assertEqual('First preprint', model.label)
+        self.assertEqual(['2110.15392', 'Q13442814', 'First preprint', 'A. Author', 'B. Author', '10.1/A'],
+                         [snak['datavalue']['value'] for snak in model.input_snaks])
+        self.assertEqual('Second', Model.prepare_data('gr-qc/0204022').label)
+        arxiv_xml.assert_called_once()
+
+    @mock.patch('arxiv.Model.arxiv_xml', return_value=ElementTree.fromstring(FEED))
+    def test_unregistered_doi(self, _, check_doi, *__):
+        check_doi.side_effect = lambda dois: set()
+        self.assertNotIn('P356', [snak['property'] for snak in Model.prepare_data('2110.15392').input_snaks])
+        check_doi.assert_called_once()
+
+    @mock.patch('arxiv.Model.arxiv_xml', side_effect=[ElementTree.fromstring(FEED.split('<entry>')[0] + '</feed>'),
+                                                      ElementTree.fromstring(FEED)])
+    def test_malformed_id(self, arxiv_xml, *_):
+        Model._Model__wanted.add('bad')
+        self.assertEqual('First preprint', Model.prepare_data('2110.15392').label)
+        self.assertEqual('api/query?max_results=1&id_list=2110.15392', arxiv_xml.call_args.args[0])
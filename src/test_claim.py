@@ -1,7 +1,10 @@
+import json
+import threading
+import time
 from unittest import mock, TestCase
 from unittest.mock import MagicMock
 
-from wd import Claim, Wikidata, Element
+from wd import Claim, Element, Throttle, Wikidata
 
 
 class TestPreload(TestCase):
@@ -29,6 +32,33 @@ class TestPreload(TestCase):
         self.assertEqual('Q1111', Claim._redirects['Q2222'])
 
 
+@mock.patch('wd.Wikidata.type_of', return_value='external-id')
+class TestFlush(TestCase):
+    @mock.patch('wd.Wikidata.edit', return_value={'success': 1})
+    def test_grouped(self, edit, _):
+        Claim.construct(Wikidata.create_snak('P818', '2101.00001'), 'Q1').save_later('a')
+        Claim.construct(Wikidata.create_snak('P356', '10.1/A'), 'Q1').save_later('b')
+        Claim.construct(Wikidata.create_snak('P356', '10.1/B'), 'Q2').save_later('c')
+        edit.assert_not_called()
+        Claim.flush()
+        self.assertEqual(2, edit.call_count)  # items are written concurrently, so order is not defined
+        single, grouped = sorted(edit.call_args_list, key=lambda c: len(c.args))
+        self.assertEqual('wbsetclaim', single.kwargs['method'])
+        self.assertEqual('c', single.kwargs['data']['summary'])
+        data, method = grouped.args
+        self.assertEqual(('wbeditentity', 'Q1', 'a; b'), (method, data['id'], data['summary']))
+        self.assertEqual(2, len(json.loads(data['data'])['claims']))
+        self.assertEqual({}, Claim._pending)
+
+    @mock.patch('wd.Wikidata.edit', return_value=None)
+    def test_fallback(self, edit, _):
+        Claim.construct(Wikidata.create_snak('P818', '2101.00001'), 'Q1').save_later('a')
+        Claim.construct(Wikidata.create_snak('P356', '10.1/A'), 'Q1').save_later('b')
+        Claim.flush()
+        self.assertEqual(['wbeditentity', 'wbsetclaim', 'wbsetclaim'],
+                         [c.args[1] if c.args else c.kwargs['method'] for c in edit.call_args_list])
+
+
 @mock.patch('wd.Wikidata.type_of', return_value='wikibase-item')
 class TestDeduplicates(TestCase):
     def test_simple_duplicate_no_wdpy(self, _):
@@ -163,3 +193,24 @@ class TestCreateRef(TestCase):
     @mock.patch('wd.Wikidata.type_of', return_value='wikibase-item')
     def test_db_ref(self, _):
         self.assertNotIn('P12132', Claim._create_ref('Q1385430', {'P12132': 'Q1385430'})['snaks'])
+
+
+class TestConcurrentFlush(TestCase):
+    @mock.patch('wd.Wikidata.type_of', return_value='external-id')
+    @mock.patch('wd.Wikidata.throttle', new_callable=Throttle)
+    @mock.patch('wd.Wikidata.call')
+    def test_window(self, call, throttle, _):
+        active, lock = [], threading.Lock()
+
+        def edit(*_):
+            with lock:
+                active.append(throttle.active)
+            time.sleep(0.05)
+            return {'success': 1}
+
+        call.side_effect, throttle.window, throttle.delay = edit, 3.0, 0.0
+        for i in range(6):
+            Claim.construct(Wikidata.create_snak('P818', '2101.0000' + str(i)), 'Q' + str(i)).save_later('a')
+        Claim.flush()
+        self.assertEqual(6, call.call_count)
+        self.assertEqual(3, max(active))  # edits of different items were in flight at the same time
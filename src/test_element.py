@@ -34,6 +34,63 @@ class TestElement(TestCase):
         self.assertIsNotNone(self.wd.find_claim(snak1999))
 
 
+class TestPrefetch(TestCase):
+    def tearDown(self):
+        Element.get_cache(reset={})
+        Element._prefetched = {}
+
+    @mock.patch('wd.Wikidata.load', return_value={'Q1': {'id': 'Q1', 'labels': {}, 'claims': {}}})
+    def test_single_batch(self, load):
+        Element.get_cache(reset={'a': 'Q1', 'b': None, 'c': 'Q2'})
+        self.assertEqual('a', next(ids := Element.prefetch(['a', 'b', 'c'])))
+        load.assert_called_once_with({'Q1', 'Q2'})
+        self.assertEqual('Q1', Element('a').entity['id'])
+        self.assertEqual(['b', 'c'], list(ids))
+        load.assert_called_once()
+
+    @mock.patch('wd.Wikidata.load', return_value=None)
+    def test_batch_size(self, load):
+        Element.get_cache(reset={'a': 'Q1', 'b': 'Q2', 'c': 'Q3'})
+        self.assertEqual(['a', 'b', 'c'], list(Element.prefetch(['a', 'b', 'c'], 2)))
+        load.assert_has_calls([mock.call({'Q1', 'Q2'}), mock.call({'Q3'})])
+
+    @mock.patch('wd.Wikidata.load', side_effect=lambda qids: {q: {'id': q, 'labels': {}, 'claims': {}} for q in qids})
+    def test_lagging_consumer(self, _):
+        Element.get_cache(reset={'a': 'Q1', 'b': 'Q2', 'c': 'Q3', 'd': 'Q4'})
+        ids = Element.prefetch(['a', 'b', 'c', 'd'], 1)
+        self.assertEqual(['a', 'b'], [next(ids), next(ids)])  # look-ahead crossed batch boundary
+        self.assertEqual({'Q1', 'Q2'}, set(Element._prefetched))
+        self.assertEqual('Q1', Element('a').entity['id'])
+        self.assertEqual(['c', 'd'], list(ids))
+        self.assertEqual({'Q3', 'Q4'}, set(Element._prefetched))  # unused ones are not kept forever
+
+
+class TestResolve(TestCase):
+    def tearDown(self):
+        Element._statements = {}
+
+    @mock.patch('wd.Wikidata.search')
+    @mock.patch('wd.Wikidata.rows', return_value=iter([['P1', 'a', 'Q1'], ['P1', 'b', 'Q2'], ['P1', 'b', 'Q3']]))
+    def test_memo(self, rows, search):
+        resolved = Element.resolve([('P1', 'a'), ('P1', 'b'), ('P1', 'c'), ('P1', '')])
+        rows.assert_called_once()
+        self.assertIn('(wd:P1 "a")', rows.call_args[0][0])
+        self.assertEqual({}, Element._statements)  # nothing is left for unrelated haswbstatement() calls
+        self.assertEqual('Q1', Element.haswbstatement('a', 'P1', resolved))
+        with self.assertRaises(ValueError) as e:
+            Element.haswbstatement('b', 'P1', resolved)
+        self.assertEqual(2, e.exception.args[0])
+        self.assertIsNone(Element.haswbstatement('c', 'P1', resolved))
+        search.assert_not_called()
+        Element.haswbstatement('a', 'P1', resolved)  # memo is consumed
+        search.assert_called_once_with('haswbstatement:"P1=a"')
+
+    @mock.patch('wd.Wikidata.rows', return_value=None)
+    def test_failure(self, rows):
+        self.assertEqual({}, Element.resolve([('P1', 'a'), ('P1', 'b'), ('P1', 'c')], 2))
+        self.assertEqual(2, rows.call_count)
+
+
 @mock.patch('wd.Wikidata.type_of', return_value='wikibase-item')
 class TestRemoveAllButOne(TestCase):
     @classmethod
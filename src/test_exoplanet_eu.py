@@ -84,3 +84,102 @@ class TestModel(TestCase):
     @mock.patch('wd.Wikidata.request', return_value=None)
     def test_failed_request(self, _):
         self.assertIsNone(Model.prepare_data('test'))
+
+
+class TestPrefetchPages(TestCase):
+    @mock.patch('exoplanet_eu.Model.download', side_effect=lambda x: ('https://exoplanet.eu/catalog/' + x, x.upper()))
+    def test_prefetch(self, download):
+        for planet in Model.prefetch_pages(['a', 'b', 'c'], ahead=1):
+            self.assertEqual(planet.upper(), Model.page(planet)[1])  # host star pass reuses the same page
+        self.assertEqual(3, download.call_count)
+        self.assertEqual({}, Model._Model__pages)
+        Model.page('a')
+        self.assertEqual(4, download.call_count)
+
+
+class TestParse(TestCase):
+    PAGE = """<html><head><script>var x = 1;</script></head><body><nav>menu</nav>
+        <div id="planet-detail-basic-info"><dd>Kepler-338 d</dd>
+        <div><span>2015</span><div id="planet_field_publications_discovered"></div></div></div>
+        <ul><li class="publication" id="publication_1"><h5>Title</h5></li></ul></body></html>"""
+    # trimmed down exoplanet.eu planet page: same regions and field markup as the real one, but not a saved copy
+    LAYOUT = """<!DOCTYPE html>
+<html lang="en">
+<head>
+  <meta charset="utf-8"><title>Planet 51 Peg b</title>
+  <link rel="stylesheet" href="/static/css/main.css"><script src="/static/js/bootstrap.bundle.min.js"></script>
+</head>
+<body>
+<header><nav class="navbar navbar-expand-lg"><a class="navbar-brand" href="/">The Extrasolar Planets Encyclopaedia</a>
+  <ul class="navbar-nav"><li class="nav-item"><a class="nav-link" href="/catalog/">Catalog</a></li></ul></nav></header>
+<main class="container">
+  <div class="row">
+    <div class="col-lg-6" id="planet-detail-basic-info">
+      <dl class="row"><dt class="col-sm-4">Planet</dt><dd class="col-sm-8"> 51 Peg b </dd></dl>
+      <div class="list-group">
+        <div class="row d-flex justify-content-between"><div class="col">Discovered in</div><span>1995</span>
+          <div class="row collapse" id="planet_field_publications_discovered"><ul class="list-group">
+            <li class="list-group-item"><a href="#publication_1">Mayor &amp; Queloz 1995</a></li></ul></div></div>
+        <div class="row d-flex justify-content-between"><div class="col">Detection method</div>
+          <span>Radial Velocity</span>
+          <div class="row collapse" id="planet_field_publications_detection_type"></div></div>
+      </div>
+    </div>
+    <div class="col-lg-6" id="planet-detail-parameters">
+      <div class="row d-flex justify-content-between"><div class="col">Mass (M<sub>J</sub>)</div>
+        <span>0.46 (&#177; 0.02) MJ</span>
+        <div class="row collapse" id="planet_field_publications_mass"></div></div>
+      <div class="row d-flex justify-content-between"><div class="col">Orbital period</div>
+        <span>4.230785 (&#177; 3.6e-05) day</span>
+        <div class="row collapse" id="planet_field_publications_period"></div></div>
+    </div>
+  </div>
+  <div class="row" id="star-detail-1">
+    <dl class="row"><dt class="col-sm-4">Star</dt><dd class="col-sm-8"> 51 Peg </dd></dl>
+    <div class="row d-flex justify-content-between"><div class="col">Distance</div><span>15.47 (&#177; 0.01) pc</span>
+      <div class="row collapse" id="star_field_publications_stars__distance"></div></div>
+  </div>
+  <ul class="list-group" id="publications">
+    <li class="list-group-item publication" id="publication_1"><h5>A Jupiter-mass companion to a solar-type star</h5>
+      <a href="https://ui.adsabs.harvard.edu/abs/1995Natur.378..355M/abstract">ADS</a></li>
+  </ul>
+</main>
+<footer><p>Maintained by Jean Schneider</p></footer>
+<script>document.addEventListener('DOMContentLoaded', function () {});</script>
+</body>
+</html>"""
+
+    @staticmethod
+    def extract(page) -> list:
+        fields = [*Model.config('planet'), *Model.config('star')]
+        return [ref.parent.findChild('span').text if (ref := page.find(id=f)) else None for f in fields] + [
+            str(page.select_one(s)) for s in ['#planet-detail-basic-info dd', '[id^=star-detail] dd']]
+
+    def test_layout_page(self):
+        page = Model.parse(self.LAYOUT)
+        self.assertIsNone(page.find('footer'))
+        self.assertEqual(self.extract(Model.parse(self.LAYOUT, selective=False)), self.extract(page))
+
+    def test_fields_moved(self):  # basic info is still in place, but fields are no longer within REGIONS
+        with self.assertLogs(level='WARNING'):
+            page = Model.parse("""<div id="planet-detail-basic-info"><dd>Kepler-338 d</dd></div><nav>menu</nav>
+                <section><div><span>2015</span><div id="planet_field_publications_discovered"></div></div></section>""")
+        self.assertIsNotNone(page.find('nav'))
+        self.assertEqual('2015', page.find(id='planet_field_publications_discovered').parent.span.text)
+
+    def test_some_fields_moved(self):
+        with self.assertLogs(level='WARNING') as log:
+            page = Model.parse(self.LAYOUT.replace('id="planet-detail-parameters"', 'id="renamed"'))
+        self.assertIn('planet_field_publications_mass', log.output[0])
+        self.assertNotIn('planet_field_publications_discovered', log.output[0])
+        self.assertEqual(self.extract(Model.parse(self.LAYOUT, selective=False)), self.extract(page))
+
+    def test_selective(self):
+        page = Model.parse(self.PAGE)
+        self.assertIsNone(page.find('script'))
+        self.assertIsNone(page.find('nav'))
+        self.assertEqual('Kepler-338 d', page.select_one('#planet-detail-basic-info dd').text)
+        self.assertEqual(['publication_1'], [p.get('id') for p in page.find_all('li', {'class': 'publication'})])
+
+    def test_fallback(self):
+        self.assertIsNotNone(Model.parse(self.PAGE.replace('planet-detail-basic-info', 'renamed')).find('nav'))
@@ -1,8 +1,36 @@
+import os
+import tempfile
 from unittest import TestCase, mock
 
 from wd import Model
 
 
+class Pid(Model):
+    @classmethod
+    def prepare_data(cls, external_id: str):
+        return cls(external_id, [os.getpid()])
+
+
+class Cited(Pid):
+    @classmethod
+    def prepare_data(cls, external_id: str):
+        if external_id == 'new':
+            Pid.get_or_create('missing')  # referenced item has to be created
+        return super().prepare_data(external_id)
+
+
+class Failing(Pid):
+    PARENT = os.getpid()
+
+    @classmethod
+    def prepare_data(cls, external_id: str):
+        if os.getpid() != Failing.PARENT:  # only in forked worker
+            if external_id == 'killed':
+                os._exit(1)
+            raise ValueError(external_id)
+        return super().prepare_data(external_id)
+
+
 class TestEnrichQualifier(TestCase):
     @mock.patch('wd.Wikidata.type_of', return_value='string')
     @mock.patch('wd.Model.config', return_value={'id': 'P972', 'translate': {'HD ': 'Q111130'}})
@@ -15,3 +43,101 @@ class TestEnrichQualifier(TestCase):
     def test_default_qualifier(self, _, __):
         peri = Model.enrich_qualifier(Model.transform('P11796', 100), '')
         self.assertEqual([('P6259', 'Q1264450')], peri['qualifiers'])
+
+
+class TestCheckpoint(TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.model = type('Model', (Model,), {'_checkpoint': self.folder.name + '/bot'})
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def interrupted_run(self):
+        self.assertEqual(0, self.model.checkpoint(0))
+        self.assertEqual(10, self.model.checkpoint(10))
+        pending = self.model.pending(['a', 'b', 'c'], prefetch=False)
+        self.assertEqual(['a', 'b'], [next(pending), next(pending)])  # interrupted while processing 'b'
+
+    @mock.patch('wd.Model.config', return_value=3600)
+    def test_resume(self, _):
+        self.interrupted_run()
+        resumed = type('Model', (Model,), {'_checkpoint': self.model._checkpoint})
+        self.assertEqual(10, resumed.checkpoint(0))
+        self.assertEqual(['b', 'c'], list(resumed.pending(['a', 'b', 'c'], prefetch=False)))
+        self.assertEqual(20, resumed.checkpoint(20))
+        self.assertEqual(['a'], list(resumed.pending(['a'], prefetch=False)))
+
+    @mock.patch('wd.Model.config', return_value=None)
+    def test_expired(self, _):
+        self.interrupted_run()
+        self.assertEqual(0, type('Model', (Model,), {'_checkpoint': self.model._checkpoint}).checkpoint(0))
+
+    def test_complete(self):
+        self.interrupted_run()
+        self.assertIsNone(self.model.checkpoint(None))
+        self.assertEqual([], os.listdir(self.folder.name))
+
+    def test_disabled(self):
+        self.assertEqual(5, Model.checkpoint(5))
+        self.assertEqual(['a', 'b'], list(Model.pending(['a', 'b'], prefetch=False)))
+        self.assertIsNone(Model._done)
+
+
+@mock.patch('wd.Element.apply')
+class TestPrepareParallel(TestCase):
+    def tearDown(self):
+        Pid.prepare_parallel([])
+
+    @mock.patch('wd.Model.WORKERS', 2)
+    def test_forked(self, apply):
+        Pid.prepare_parallel(['a', 'b'])
+        Pid.get_by_id('b', forced=True)
+        self.assertEqual('b', (data := apply.call_args[0][0]).external_id)
+        self.assertNotEqual(os.getpid(), data.input_snaks[0])
+        Pid.prepare_parallel(['c'])  # result for 'a' is discarded
+        Pid.get_by_id('a', forced=True)
+        self.assertEqual(os.getpid(), apply.call_args[0][0].input_snaks[0])
+
+    def test_sequential(self, apply):
+        Pid.prepare_parallel(['a'])
+        Pid.get_by_id('a', forced=True)
+        self.assertEqual(os.getpid(), apply.call_args[0][0].input_snaks[0])
+
+    @mock.patch('wd.Model.WORKERS', 2)
+    @mock.patch('wd.Element.get_qid', return_value=None)
+    @mock.patch('wd.Element.has_to_be_created', return_value=True)
+    @mock.patch('wd.Element.save')
+    def test_deferred(self, save, _, __, apply):
+        Cited.prepare_parallel(['old', 'new'])
+        Cited.get_by_id('old', forced=True)
+        self.assertNotEqual(os.getpid(), apply.call_args[0][0].input_snaks[0])
+        Cited.get_by_id('new', forced=True)
+        self.assertEqual(os.getpid(), apply.call_args[0][0].input_snaks[0])  # worker left it to main process
+        save.assert_called_once()  # 'missing' is created by main process only
+
+    @mock.patch('wd.Model.WORKERS', 2)
+    @mock.patch('wd.Model.QUEUED', 1)
+    def test_window(self, _):
+        Pid.prepare_parallel(['a', 'b', 'c', 'd'])
+        self.assertEqual([(Pid, 'a'), (Pid, 'b')], list(Model._Model__prepared))
+        Pid.get_by_id('a', forced=True)
+        self.assertEqual([(Pid, 'b'), (Pid, 'c')], list(Model._Model__prepared))
+        Pid.get_by_id('c', forced=True)  # 'b' was skipped by the caller
+        self.assertEqual([(Pid, 'd')], list(Model._Model__prepared))
+
+    @mock.patch('wd.Model.WORKERS', 2)
+    def test_worker_failed(self, apply):
+        Failing.prepare_parallel(['failed'])
+        with self.assertLogs(level='WARNING'):
+            Failing.get_by_id('failed', forced=True)
+        self.assertEqual(os.getpid(), apply.call_args[0][0].input_snaks[0])  # prepared by main process instead
+
+    @mock.patch('wd.Model.WORKERS', 2)
+    def test_worker_killed(self, apply):
+        Failing.prepare_parallel(['killed', 'next'])
+        with self.assertLogs(level='ERROR'):
+            Failing.get_by_id('killed', forced=True)
+        self.assertEqual(os.getpid(), apply.call_args[0][0].input_snaks[0])
+        Failing.get_by_id('next', forced=True)
+        self.assertEqual(os.getpid(), apply.call_args[0][0].input_snaks[0])  # pool is broken, so no more workers
@@ -0,0 +1,32 @@
+from unittest import TestCase
+
+from wd import QidMap
+
+
+class TestQidMap(TestCase):
+    def test_dict_interface(self):
+        cache = QidMap({'b': 'Q2', 'a': 'Q1', 'c': None})
+        self.assertEqual(3, len(cache))
+        self.assertEqual('Q1', cache['a'])
+        self.assertIsNone(cache['c'])
+        self.assertIn('c', cache)
+        self.assertNotIn('d', cache)
+        self.assertIsNone(cache.get('d'))
+        self.assertEqual(['a', 'b', 'c'], list(cache.keys()))
+        self.assertDictEqual({'a': 'Q1', 'b': 'Q2', 'c': None}, dict(cache))
+        self.assertRaises(ValueError, cache.__setitem__, 'd', 'P31')
+        self.assertRaises(ValueError, cache.__setitem__, 'd', 'Q99999999999')
+
+    def test_merge(self):
+        cache = QidMap((str(i), 'Q' + str(i)) for i in range(5000))
+        cache['100'], cache['x'] = None, 'Q42'
+        del cache['200']
+        self.assertIsNone(cache['100'])
+        self.assertEqual('Q42', cache['x'])
+        self.assertNotIn('200', cache)
+        self.assertEqual(5000, len(cache))
+        self.assertEqual(sorted(cache.keys()), list(cache.keys()))
+        cache['200'] = 'Q200'
+        self.assertEqual('Q200', cache['200'])
+        self.assertEqual(5001, len(cache))
+        self.assertRaises(KeyError, cache.__delitem__, 'y')
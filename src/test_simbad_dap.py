@@ -0,0 +1,31 @@
+from unittest import TestCase, mock
+
+from simbad_dap import Model
+
+
+class TestLoadRange(TestCase):
+    @mock.patch('simbad_dap.Model._Model__ranges', new_callable=dict)
+    @mock.patch('simbad_dap.Model.load', side_effect=lambda condition, _: {condition: []})
+    def test_ahead(self, _, ranges):
+        self.assertEqual({'oid BETWEEN 0 AND 10000': []}, Model.load_range(0))
+        self.assertEqual([10000, 20000], sorted(ranges))  # AHEAD following ranges are being loaded
+        self.assertEqual({'oid BETWEEN 10000 AND 20000': []}, Model.load_range(10000))
+        self.assertEqual([20000, 30000], sorted(ranges))
+        Model.load_range(50000)  # position was moved, so ranges in between are dropped
+        self.assertEqual([60000, 70000], sorted(ranges))
+
+
+@mock.patch('simbad_dap.Model._Model__offset', 0)
+@mock.patch('simbad_dap.Model._Model__ranges', new_callable=dict)
+@mock.patch('simbad_dap.Model.prefetch_references')
+@mock.patch('simbad_dap.Model.checkpoint', side_effect=lambda cursor: cursor)
+class TestNext(TestCase):
+    @mock.patch('simbad_dap.Model.load_range', return_value=None)
+    def test_failed(self, _, checkpoint, *__):
+        self.assertIsNone(Model.next())
+        checkpoint.assert_called_once_with(0)  # position is kept to resume from it
+
+    @mock.patch('simbad_dap.Model.load_range', return_value={})
+    def test_complete(self, _, checkpoint, *__):
+        self.assertEqual([], list(Model.next()))
+        checkpoint.assert_called_with(None)
@@ -0,0 +1,65 @@
+import json
+from unittest import TestCase, mock
+
+import stand_in
+from wd import AstroModel, Element, Wikidata
+
+
+class TestStandIn(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = stand_in.serve(0)
+        cls.url = 'http://localhost:{}'.format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        stand_in.Handler.store, stand_in.Handler.tap = stand_in.Store(), ''
+        self.patch = mock.patch('wd.Wikidata.SERVER', self.url)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def test_redirect(self):
+        self.assertEqual(self.url + '/w/api.php', Wikidata.redirect('https://www.wikidata.org/w/api.php'))
+        self.assertEqual(self.url + '/TAP/sync', Wikidata.redirect('https://simbad.cds.unistra.fr/TAP/sync'))
+        self.assertEqual('https://exoplanet.eu/catalog/', Wikidata.redirect('https://exoplanet.eu/catalog/'))
+
+    def test_round_trip(self):
+        snak = {'snaktype': 'value', 'property': 'P3083', 'datavalue': {'value': 'HD 1', 'type': 'string'}}
+        entity = {'claims': [{'mainsnak': snak, 'type': 'statement'}],
+                  'labels': {'en': {'value': 'HD 1', 'language': 'en'}}}
+        data = {'new': 'item', 'summary': 'test', 'data': json.dumps(entity)}
+        qid = Wikidata.edit(data, 'wbeditentity')['entity']['id']
+        self.assertEqual(qid, Wikidata.search('haswbstatement:"P3083=HD 1"'))
+        self.assertEqual({'HD 1': qid}, Wikidata.query('SELECT ?c ?i { ?i p:P3083/ps:P3083 ?c }'))
+        resolved = Element.resolve([('P3083', 'HD 1'), ('P3083', 'HD 2')])
+        self.assertEqual(qid, Element.haswbstatement('HD 1', 'P3083', resolved))
+        self.assertIsNone(Element.haswbstatement('HD 2', 'P3083', resolved))
+        self.assertEqual('HD 1', Wikidata.load({qid})[qid]['labels']['en']['value'])
+
+    @mock.patch('wd.Wikidata._Wikidata__types', None)
+    def test_types(self):
+        with mock.patch('stand_in.Handler.types', {'P31': 'wikibase-item', 'P3083': 'external-id'}), \
+                mock.patch('wd.Wikidata.TYPES', list(Wikidata.TYPES)):
+            self.assertEqual('external-id', Wikidata.type_of('P3083'))
+            self.assertEqual('Q5', Wikidata.create_snak('P31', 'Q5')['datavalue']['value']['id'])
+
+    def test_unknown_query(self):
+        value = {'value': {'id': 'Q1'}, 'type': 'wikibase-entityid'}
+        snak = {'snaktype': 'value', 'property': 'P397', 'datavalue': value}
+        Wikidata.edit({'new': 'item', 'data': json.dumps({'claims': [{'mainsnak': snak, 'type': 'statement'}]})},
+                      'wbeditentity')
+        self.assertEqual({}, Wikidata.query('SELECT DISTINCT ?c ?i { ?i ^ps:P397 []; wdt:P528 ?c }'))
+
+    def test_tap(self):
+        adql = 'SELECT main_id, oid FROM basic WHERE {}'
+        self.assertEqual({}, AstroModel.query(self.url + '/TAP', adql.format('oid BETWEEN 0 AND 10')))
+        stand_in.Handler.tap = 'main_id,oid,p31\r\nHD 1,5,Q523\r\nHD 2,15,Q523\r\n'
+        self.assertEqual(['HD 1'], list(AstroModel.query(self.url + '/TAP', adql.format('oid BETWEEN 0 AND 10'))))
+        self.assertEqual({}, AstroModel.query(self.url + '/TAP', adql.format('oid BETWEEN 20 AND 30')))
+        self.assertEqual(['HD 2'], list(AstroModel.query(self.url + '/TAP', adql.format("main_id = 'HD 2'"))))
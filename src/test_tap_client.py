@@ -1,3 +1,5 @@
+import os
+import tempfile
 from unittest import TestCase, mock
 from unittest.mock import MagicMock
 
@@ -162,3 +164,38 @@ class TestParseUrl(TestCase):
         value = AstroModel.parse_url('http://www.aanda.org/....url=/articles/aa/abs/2004/18/aa0959/aa0959.html')
         self.assertEqual('Q53953306', value)
         api_search.assert_called_with('haswbstatement:P356=10.1051/0004-6361:20035959')
+
+
+class TestQueryCache(TestCase):
+    @mock.patch('wd.Wikidata.request')
+    def test_reuse(self, mock_request):
+        mock_request.return_value = MagicMock(iter_lines=lambda decode_unicode: iter(['main_id,p31', 'HD 1,Q5']))
+        with tempfile.TemporaryDirectory() as folder, mock.patch('wd.Wikidata.STORAGE', folder):
+            self.assertDictEqual({'HD 1': [{'p31': 'Q5'}]}, AstroModel.query('https://tap.test', 'select', ttl=60))
+            self.assertDictEqual({'HD 1': [{'p31': 'Q5'}]}, AstroModel.query('https://tap.test', 'select', ttl=60))
+            mock_request.assert_called_once()
+            AstroModel.query('https://tap.test', 'select * from basic', ttl=60)
+            self.assertEqual(2, mock_request.call_count)
+
+    @mock.patch('wd.Wikidata._Wikidata__evicted', False)
+    @mock.patch('wd.Wikidata.request', return_value=None)
+    def test_evict(self, _):
+        with tempfile.TemporaryDirectory() as folder, mock.patch('wd.Wikidata.STORAGE', folder):
+            os.makedirs(os.path.join(folder, 'query', '60'))
+            for name in ['legacy.csv', os.path.join('60', 'expired.csv'), os.path.join('60', 'fresh.csv')]:
+                open(os.path.join(folder, 'query', name), 'w').close()
+            os.utime(os.path.join(folder, 'query', '60', 'expired.csv'), (0, 0))
+            AstroModel.query('https://tap.test', 'select', ttl=60)
+            self.assertEqual(['fresh.csv'], os.listdir(os.path.join(folder, 'query', '60')))
+            self.assertEqual(['60'], os.listdir(os.path.join(folder, 'query')))
+
+
+class TestLoad(TestCase):
+    RESULTS = {'SELECT q1': {'HD 1': [{'q': 'q1'}], 'HD 2': [{'q': 'q1'}]}, 'SELECT q2': {'HD 1': [{'q': 'q2'}]}}
+    CONFIG = {'queries': [['SELECT q1'], ['SELECT q2']]}
+
+    @mock.patch('wd.AstroModel.query', side_effect=lambda _, adql, ttl=None: TestLoad.RESULTS[adql])
+    @mock.patch('wd.AstroModel.config', side_effect=lambda *key: TestLoad.CONFIG.get(key[0]))
+    def test_merge_in_order(self, _, query):
+        self.assertEqual({'HD 1': [{'q': 'q1'}, {'q': 'q2'}], 'HD 2': [{'q': 'q1'}]}, AstroModel.load())
+        self.assertEqual(2, query.call_count)
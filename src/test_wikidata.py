@@ -1,10 +1,15 @@
 #!/usr/bin/python3
 import json
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from decimal import Decimal
 from unittest import TestCase, mock
 from unittest.mock import MagicMock
 
-from wd import Wikidata
+from wd import Backoff, Metrics, QidMap, Stats, Throttle, Wikidata
 
 
 class TestRequest(TestCase):
@@ -13,7 +18,7 @@ class TestRequest(TestCase):
     @mock.patch('requests.Session.get', return_value=MagicMock(status_code=200, content='get-response'))
     def test_get_200(self, mock_get):
         self.assertEqual('get-response', Wikidata.request('https://test.test').content)
-        mock_get.assert_called_with('https://test.test')
+        mock_get.assert_called_with('https://test.test', timeout=Wikidata.TIMEOUT)
 
     @mock.patch('requests.Session.get', return_value=MagicMock(status_code=400, content='get-response'))
     @mock.patch('logging.error')
@@ -24,13 +29,17 @@ class TestRequest(TestCase):
     @mock.patch('logging.error')
     def test_get_exception(self, mock_error, mock_get):
         self.assertIsNone(Wikidata.request('https://test.test'))
-        mock_get.assert_called_with('https://test.test')
+        mock_get.assert_called_with('https://test.test', timeout=Wikidata.TIMEOUT)
         mock_error.assert_called_with('https://test.test exception:  POST {}')
 
     @mock.patch('requests.Session.post', return_value=MagicMock(status_code=200, content='post-response'))
     def test_post_200(self, _):
         self.assertEqual('post-response', Wikidata.request("https://test.test", data={'1': 1}).content)
 
+    def test_shared_session(self):
+        self.assertIs(Wikidata.session('https://test.test/a'), Wikidata.session('https://test.test/b?c=d'))
+        self.assertIsNot(Wikidata.session('https://test.test/a'), Wikidata.session('https://other.test/a'))
+
 
 class TestCall(TestCase):
     @mock.patch('wd.Wikidata.request', return_value=None)
@@ -53,6 +62,211 @@ class TestLoad(TestCase):
     def test_no_entities(self, _):
         self.assertEqual({}, Wikidata.load({'Q1'}))
 
+    @mock.patch('wd.Wikidata.call')
+    def test_storage(self, api_call):
+        q1, q2 = {'id': 'Q1', 'lastrevid': 1, 'claims': {}}, {'id': 'Q2', 'lastrevid': 2, 'claims': {}}
+        with tempfile.TemporaryDirectory() as folder, mock.patch('wd.Wikidata.STORAGE', folder):
+            api_call.side_effect = [{'entities': {}}, {'entities': {'Q1': q1, 'Q2': q2}}]
+            self.assertEqual({'Q1': q1, 'Q2': q2}, Wikidata.load({'Q1', 'Q2'}))
+
+            api_call.reset_mock()
+            api_call.side_effect = [{'entities': {'Q1': {'lastrevid': 1}, 'Q2': {'lastrevid': 3}}},
+                                    {'entities': {'Q2': {**q2, 'lastrevid': 3}}}]
+            self.assertEqual({'Q1': q1, 'Q2': {**q2, 'lastrevid': 3}}, Wikidata.load({'Q1', 'Q2'}))
+            api_call.assert_called_with('wbgetentities', {'props': 'claims|info|labels|aliases', 'ids': 'Q2'})
+
+
+@mock.patch('wd.Stats.slowest', new_callable=list)
+@mock.patch('wd.Stats.caches', new_callable=dict)
+@mock.patch('wd.Stats.phases', new_callable=dict)
+class TestStats(TestCase):
+    def test_phases(self, phases, *_):
+        with Stats.phase('load'):
+            pass
+        self.assertEqual(42, Stats.timed('load')(lambda x: x)(42))
+        self.assertEqual(2, phases['load'][0])
+        with self.assertRaises(ValueError):
+            with Stats.phase('save'):
+                raise ValueError()
+        self.assertEqual(1, Stats.summary()['phases']['save']['calls'])
+
+    def test_caches(self, _, caches, __):
+        for hit in [True, True, True, False]:
+            Stats.hit('get_cache', hit)
+        self.assertEqual([3, 1], caches['get_cache'])
+        self.assertEqual({'hits': 3, 'misses': 1, 'rate': 0.75}, Stats.summary()['caches']['get_cache'])
+        (counter := Stats.counter('type_of'))[0] += 1
+        self.assertIs(counter, Stats.counter('type_of'))
+        self.assertNotIn('_parents', (Stats.counter('_parents'), Stats.summary()['caches'])[1])  # never used
+        self.assertEqual(1, Stats.summary()['caches']['type_of']['hits'])
+
+    @mock.patch('wd.Stats.TOP', 2)
+    def test_slowest(self, *_):
+        with self.assertLogs(level='WARNING'):
+            for external_id, seconds in [('a', 1), ('b', 1000), ('c', 3), ('d', 2)]:
+                Stats.item(external_id, seconds)
+        self.assertEqual({'b': 1000, 'c': 3}, Stats.summary()['slowest'])
+
+    @mock.patch('wd.Wikidata.STORAGE', None)
+    def test_dump_to_log(self, *_):
+        with self.assertLogs(level='INFO') as log:
+            Stats.dump('test')
+        self.assertIn('Run statistics', log.output[0])
+
+
+class TestBackoff(TestCase):
+    @mock.patch('time.sleep')
+    def test_wait(self, sleep):
+        backoff = Backoff(budget=1)
+        self.assertTrue(backoff.wait(0, '7'))
+        sleep.assert_called_with(7.0)
+        self.assertTrue(backoff.wait(3))
+        self.assertLessEqual(sleep.call_args.args[0], Backoff.BASE * 8)
+        self.assertFalse(backoff.wait(0))  # budget is exhausted
+        self.assertTrue(backoff.wait(0, '7'))  # but server asking to wait is still waited for
+        self.assertFalse(backoff.wait(Backoff.ATTEMPTS, '7'))
+        self.assertFalse(Backoff().wait(Backoff.ATTEMPTS))
+
+    def test_retry_after(self):
+        self.assertEqual(120.0, Backoff.retry_after('120'))
+        self.assertEqual(0.0, Backoff.retry_after('Wed, 21 Oct 2015 07:28:00 GMT'))
+        self.assertIsNone(Backoff.retry_after(None))
+        self.assertIsNone(Backoff.retry_after('soon'))
+
+
+@mock.patch('wd.Metrics._Metrics__histograms', new_callable=dict)
+@mock.patch('wd.Metrics._Metrics__counters', new_callable=dict)
+class TestMetrics(TestCase):
+    def test_labels(self, *_):
+        self.assertEqual({'host': 'www.wikidata.org', 'endpoint': '/w/api.php?action=wbgetentities'},
+                         Metrics.labels('https://www.wikidata.org/w/api.php', 'ids=Q1&action=wbgetentities'))
+        self.assertEqual('/catalog/*', Metrics.labels('https://exoplanet.eu/catalog/51_peg_b--1/')['endpoint'])
+        self.assertEqual('/simbad/sim-tap', Metrics.labels('https://simbad.cds.unistra.fr/simbad/sim-tap/sync')[
+            'endpoint'])
+
+    def test_write(self, *_):
+        with tempfile.TemporaryDirectory() as folder, mock.patch('wd.Metrics.path', folder + '/wd.prom'):
+            for _ in range(2):  # chunked response without Content-Length
+                response = MagicMock(status_code=200, headers={}, elapsed=timedelta(seconds=0.3))
+                response.request.url, response.request.body = 'https://query.wikidata.org/sparql', 'query=SELECT'
+                response.iter_content = lambda *_: iter([b'01234', b'56789'])
+                Metrics.observe(response)
+                b''.join(response.iter_content(512))
+            Metrics.write(True)
+            with open(folder + '/wd.prom') as file:
+                lines = file.read().splitlines()
+        labels = 'endpoint="/sparql",host="query.wikidata.org"'
+        self.assertIn('wdpy_http_requests_total{{{},status="200"}} 2'.format(labels), lines)
+        self.assertIn('wdpy_http_received_bytes_total{{{}}} 20'.format(labels), lines)
+        self.assertIn('wdpy_http_request_seconds_bucket{{{},le="0.25"}} 0'.format(labels), lines)
+        self.assertIn('wdpy_http_request_seconds_bucket{{{},le="0.5"}} 2'.format(labels), lines)
+        self.assertIn('wdpy_http_request_seconds_count{{{}}} 2'.format(labels), lines)
+
+
+@mock.patch('wd.Wikidata.throttle', new_callable=Throttle)
+@mock.patch('time.sleep')
+class TestEdit(TestCase):
+    @mock.patch('wd.Wikidata.call')
+    def test_maxlag(self, api_call, mock_sleep, throttle):
+        api_call.side_effect = [{'error': {'code': 'maxlag', 'info': '', 'retry-after': '7'}}, {'success': 1}]
+        self.assertEqual({'success': 1}, Wikidata.edit({}, 'wbsetclaim'))
+        self.assertLess(6.9, max(c.args[0] for c in mock_sleep.call_args_list))
+        self.assertEqual(1, throttle.edits)
+
+    def test_window(self, _, throttle):
+        for _ in range(10):
+            throttle.success()
+        self.assertLess(throttle.delay, 0.5)
+        self.assertLess(1, throttle.window)
+        delay = throttle.delay
+        for _ in range(8):
+            throttle.lagged(5)
+        self.assertEqual(1, throttle.window)
+        self.assertEqual(delay, throttle.delay)  # lag is waited out via Retry-After only
+        throttle.failed()
+        self.assertLessEqual(10, throttle.delay)
+        throttle.success()
+        self.assertLess(throttle.delay, Throttle.BASE_DELAY)  # recovered after the first success
+
+    @mock.patch('wd.Wikidata._Wikidata__token', 'bad')
+    @mock.patch('wd.Wikidata.call')
+    def test_concurrent_badtoken(self, api_call, _, throttle):
+        stale, refreshed = threading.Barrier(Throttle.MAX_WINDOW), []
+
+        def call(action, params):
+            if action == 'query':
+                refreshed.append(params)
+                return {'query': {'tokens': {'csrftoken': 'csrf'}}}
+            if params['token'] == 'bad':
+                stale.wait(5)  # all threads are rejected with the same token
+                return {'error': {'code': 'badtoken', 'info': ''}}
+            return {'success': 1}
+
+        api_call.side_effect, throttle.window, throttle.delay = call, Throttle.MAX_WINDOW, 0.0
+        with ThreadPoolExecutor(Throttle.MAX_WINDOW) as pool:
+            self.assertEqual([{'success': 1}] * 4, list(pool.map(lambda _: Wikidata.edit({}, 'wbsetclaim'), range(4))))
+        self.assertEqual(1, len(refreshed))
+
+    @mock.patch('wd.Wikidata.logon')
+    @mock.patch('wd.Wikidata.call', return_value={'error': {'code': 'modification-failed', 'info': ''}})
+    def test_item_error(self, _, __, ___, throttle):
+        with self.assertLogs(level='ERROR'):
+            self.assertIsNone(Wikidata.edit({}, 'wbeditentity'))
+        self.assertEqual(Throttle.BASE_DELAY, throttle.delay)
+
+
+@mock.patch('wd.Wikidata.csv')
+class TestQuery(TestCase):
+    def test_rows(self, mock_csv):
+        mock_csv.return_value = iter([['c', 'i'], ['a', 'http://www.wikidata.org/entity/Q1'], ['b', 'x']])
+        self.assertEqual([['a', 'Q1'], ['b', 'x']], list(Wikidata.rows('SELECT ?c ?i {}')))
+
+    def test_failed(self, mock_csv):
+        mock_csv.return_value = None
+        self.assertIsNone(Wikidata.rows('SELECT ?c ?i {}'))
+        self.assertIsNone(Wikidata.query('SELECT ?c ?i {}'))
+
+    def test_in_place(self, mock_csv):
+        mock_csv.return_value = iter([['c', 'i'], ['a', 'http://www.wikidata.org/entity/Q1'], ['b']])
+        result = {'z': 'Q0'}
+        self.assertIs(result, Wikidata.query('SELECT ?c ?i {}', result=result))
+        self.assertDictEqual({'z': 'Q0', 'a': 'Q1'}, result)
+
+    def test_rejected_rows(self, mock_csv):
+        mock_csv.return_value = iter([['c', 'i'], ['a', 'http://www.wikidata.org/entity/L1'], ['b', 'Q2']])
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual({'b': 'Q2'}, dict(Wikidata.query('SELECT ?c ?i {}', result=QidMap())))
+
+
+class TestPartitioned(TestCase):
+    @staticmethod
+    def query(sparql, _, __, result):
+        """Fails (as if timed out) for ranges wider than quarter of all ids"""
+        if (found := re.search('>= (\\d+) .* < (\\d+)', sparql)) and \
+                int(found.group(2)) - int(found.group(1)) <= Wikidata.MAX_QID // 4:
+            result[found.group(1)] = 'Q' + found.group(2)
+            return result
+
+    @mock.patch('wd.Wikidata.SLOW_QUERY', -1)
+    def test_split(self):
+        with mock.patch('wd.Wikidata.query', side_effect=self.query) as query:
+            self.assertEqual(4, len(result := Wikidata.partitioned('SELECT ?c ?i { ?i p:P1/ps:P1 ?c }')))
+        self.assertEqual(1 + 2 + 4, query.call_count)
+        self.assertEqual('Q' + str(Wikidata.MAX_QID), result[str(Wikidata.MAX_QID // 4 * 3)])
+        self.assertNotIn('FILTER', query.call_args_list[0].args[0])  # the whole range is queried first
+
+    @mock.patch('wd.Wikidata.query', return_value=None)
+    def test_failed(self, query):
+        self.assertIsNone(Wikidata.partitioned('SELECT ?c ?i { ?i p:P1/ps:P1 ?c }', parts=2))
+        self.assertLessEqual(query.call_count, 2)  # quick failure is not a timeout, so it is not split
+
+    @mock.patch('wd.Wikidata.SLOW_QUERY', -1)
+    @mock.patch('wd.Wikidata.MIN_RANGE', Wikidata.MAX_QID // 4)
+    @mock.patch('wd.Wikidata.query', return_value=None)
+    def test_min_range(self, query):
+        self.assertIsNone(Wikidata.partitioned('SELECT ?c ?i { ?i p:P1/ps:P1 ?c }'))
+        self.assertLessEqual(query.call_count, 1 + 2 + 4)  # quarters are not split any more
+
 
 class TestSearch(TestCase):
     @mock.patch('wd.Wikidata.call', return_value={'query': {'search': [{'title': 'Q1091618'}]}})
@@ -61,6 +275,28 @@ class TestSearch(TestCase):
         api_call.assert_called_with('query', {'list': 'search', 'srsearch': 'haswbstatement:"P3083=HD 1"'})
 
 
+@mock.patch('wd.Wikidata._Wikidata__newest', 0)
+@mock.patch('wd.Wikidata._Wikidata__types', None)
+@mock.patch('wd.Wikidata.TYPES', ['wikibase-item', 'external-id'])
+class TestTypeOf(TestCase):
+    @mock.patch('wd.Wikidata.query')
+    def test_snapshot(self, mock_query):
+        mock_query.return_value = {'P31': 'http://wikiba.se/ontology#WikibaseItem',
+                                   'P2': 'http://wikiba.se/ontology#Url'}
+        with tempfile.TemporaryDirectory() as folder, mock.patch('wd.Wikidata.STORAGE', folder):
+            self.assertEqual('wikibase-item', Wikidata.type_of('P31'))
+            self.assertEqual(2, Wikidata.type_code('P2'))
+            mock_query.return_value = {'P42': 'http://wikiba.se/ontology#ExternalId'}
+            self.assertEqual('external-id', Wikidata.type_of('P42'))
+            self.assertIn('> 31)', mock_query.call_args.args[0])
+
+            Wikidata._Wikidata__types = None  # next run
+            with mock.patch('wd.Model.config', return_value=3600):
+                self.assertEqual('url', Wikidata.type_of('P2'))
+                self.assertIsNone(Wikidata.type_of('P40'))
+            self.assertEqual(2, mock_query.call_count)
+
+
 class TestStatic(TestCase):
     def test_format_float(self):
         self.assertEqual('0.12345679', Wikidata.format_float('0.123456789', 8))
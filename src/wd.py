@@ -1,52 +1,333 @@
 #!/usr/bin/python3
 from __future__ import annotations
 
+import atexit
 import csv
+import functools
+import hashlib
+import heapq
+import itertools
 import json
 import logging
 import math
+import multiprocessing
 import os
+import random
 import re
 import sys
+import threading
 import time
 import uuid
-from contextlib import closing
+from array import array
+from bisect import bisect_left
+from collections.abc import MutableMapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import closing, contextmanager, nullcontext
 from datetime import datetime
 from decimal import Decimal, DecimalException, InvalidOperation
-from urllib.parse import unquote
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qs, quote, unquote, urlparse
 
 import requests
 
 
+class Throttle:
+    """Feedback controller for edit rate: number of parallel edits slowly grows while server accepts edits and drops
+    immediately when server reports replication lag or errors. Lag is waited out as server asks (Retry-After), pause
+    between edits grows only after transient errors and is back to BASE_DELAY (or shorter) after the first success"""
+    MIN_DELAY, BASE_DELAY, MAX_DELAY, MAX_WINDOW, REPORT = 0.1, 0.5, 600.0, 4, 100
+    TRANSIENT = ('ratelimited', 'readonly', 'internal_api_error')  # prefixes of API error codes worth slowing down for
+
+    def __init__(self):
+        self.delay, self.window, self.active, self.edits, self.started = Throttle.BASE_DELAY, 1.0, 0, 0, time.time()
+        self.__next, self.__condition = 0.0, threading.Condition()
+
+    def __enter__(self):
+        with self.__condition:
+            self.__condition.wait_for(lambda: self.active < int(self.window))
+            self.active += 1
+            pause = max(0.0, self.__next - (now := time.time()))
+            self.__next = max(self.__next, now) + self.delay
+        time.sleep(pause)
+        Metrics.add('wdpy_sleep_seconds_total', pause, reason='throttle')
+        return self
+
+    def __exit__(self, *_):
+        with self.__condition:
+            self.active -= 1
+            self.__condition.notify_all()
+
+    def success(self):
+        with self.__condition:
+            self.delay = max(Throttle.MIN_DELAY, min(self.delay, Throttle.BASE_DELAY) * 0.9)
+            self.window = min(Throttle.MAX_WINDOW, self.window + 1 / self.window)
+            self.edits += 1
+            self.__condition.notify_all()
+        if self.edits % Throttle.REPORT == 0:
+            logging.info('{} edits, {:.1f} edits/min'.format(self.edits, self.rate()))
+
+    def lagged(self, seconds: float):
+        """Server asked to wait: postpone all edits and start from single edit at a time"""
+        with self.__condition:
+            self.window, self.__next = 1.0, max(self.__next, time.time() + seconds)
+
+    def failed(self):
+        """Transient failure (no response or error code from TRANSIENT)"""
+        with self.__condition:
+            self.delay = min(Throttle.MAX_DELAY, max(self.delay * 2, 10.0))
+            self.window = 1.0
+
+    def rate(self) -> float:
+        return 60 * self.edits / max(time.time() - self.started, 1)
+
+
+class Backoff:
+    """Exponential backoff with full jitter for transient failures, Retry-After of the server takes precedence. Retries
+    are limited per request (ATTEMPTS) and per run (budget), so that dead server does not stall the whole run. Only
+    failures without Retry-After are charged to the budget, server asking to wait is not considered dead"""
+    BASE, CAP, ATTEMPTS, TRANSIENT = 10.0, 900.0, 6, [408, 425, 429, 500, 502, 503, 504]
+
+    def __init__(self, budget: int = 30):
+        self.budget, self.__lock = budget, threading.Lock()
+
+    @staticmethod
+    def retry_after(value: str) -> float:
+        """Seconds to wait according to Retry-After header (either delay in seconds or HTTP-date), None if malformed"""
+        try:
+            return max(0.0, float(value))
+        except (TypeError, ValueError):
+            try:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+            except (TypeError, ValueError, IndexError):
+                return None
+
+    def wait(self, attempt: int, retry_after: str = None) -> bool:
+        """Sleep before retry number `attempt` (starting from 0) and return True, or False if retries are exhausted"""
+        if attempt >= Backoff.ATTEMPTS:
+            return False
+        if (pause := Backoff.retry_after(retry_after)) is None:
+            with self.__lock:
+                if self.budget <= 0:
+                    return False
+                self.budget -= 1
+            pause = random.uniform(0, min(Backoff.CAP, Backoff.BASE * 2 ** attempt))
+        Metrics.add('wdpy_sleep_seconds_total', pause, reason='backoff')
+        time.sleep(pause)
+        return True
+
+
+class Stats:
+    """Number of calls and wall time (including nested phases) of every phase of the run, cache hit rates and slowest
+    items. Summary is written at exit into persistent storage (or log if storage is disabled)"""
+    SLOW, TOP, started, phases, caches, slowest, __lock = 300.0, 20, time.time(), {}, {}, [], threading.Lock()
+
+    @staticmethod
+    @contextmanager
+    def phase(name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with Stats.__lock:
+                (entry := Stats.phases.setdefault(name, [0, 0.0]))[0] += 1
+                entry[1] += time.perf_counter() - started
+
+    @staticmethod
+    def timed(name: str):
+        """Decorator accounting every call of the function as the phase"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with Stats.phase(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def hit(cache: str, hit: bool):
+        with Stats.__lock:
+            Stats.caches.setdefault(cache, [0, 0])[0 if hit else 1] += 1
+
+    @staticmethod
+    def counter(cache: str) -> list:
+        """[hits, misses] of the cache, for hot paths that increment it without the lock (a rare lost update is ok)"""
+        with Stats.__lock:
+            return Stats.caches.setdefault(cache, [0, 0])
+
+    @staticmethod
+    def item(external_id: str, seconds: float):
+        """Keep TOP slowest items, warn about ones that took more than SLOW seconds"""
+        if seconds > Stats.SLOW:
+            logging.warning('"{}" took {:.0f}s'.format(external_id, seconds))
+        with Stats.__lock:
+            (heapq.heappush if len(Stats.slowest) < Stats.TOP else heapq.heappushpop)(Stats.slowest,
+                                                                                      (seconds, external_id))
+
+    @staticmethod
+    def summary() -> dict:
+        with Stats.__lock:
+            return {'started': datetime.fromtimestamp(Stats.started).isoformat(timespec='seconds'),
+                    'seconds': round(time.time() - Stats.started, 1),
+                    'phases': {name: {'calls': calls, 'seconds': round(seconds, 3)} for name, (calls, seconds) in
+                               Stats.phases.items()},
+                    'caches': {name: {'hits': hits, 'misses': misses, 'rate': round(hits / (hits + misses), 4)} for
+                               name, (hits, misses) in Stats.caches.items() if hits + misses},
+                    'slowest': {external_id: round(seconds, 1) for seconds, external_id in sorted(Stats.slowest,
+                                                                                                  reverse=True)}}
+
+    @staticmethod
+    def dump(name: str):
+        if path := Wikidata.storage('stats', '{}.{}.json'.format(name, time.strftime('%Y%m%d%H%M%S'))):
+            with open(path, 'w') as file:
+                json.dump(Stats.summary(), file, indent=1)
+        else:
+            logging.info('Run statistics: ' + json.dumps(Stats.summary()))
+
+
+class Metrics:
+    """HTTP counters and latency histograms per host and endpoint, exposed as Prometheus text file every INTERVAL
+    seconds, see https://prometheus.io/docs/instrumenting/exposition_formats/"""
+    BUCKETS, INTERVAL, path, __written = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, math.inf), 60, None, 0.0
+    __counters, __histograms, __lock = {}, {}, threading.Lock()
+
+    @staticmethod
+    def labels(url: str, data=None) -> dict[str, str]:
+        """Host and up to 2 first segments of the path (ones with digits are masked), action for Wikidata API"""
+        parts = (parsed := urlparse(url)).path.split('/')[:3]
+        endpoint = '/'.join(['*' if re.search('\\d', part) else part for part in parts])
+        if endpoint.endswith('api.php') and (action := parse_qs(data if isinstance(data, str) else '').get('action')):
+            endpoint += '?action=' + action[0]
+        return {'host': parsed.netloc, 'endpoint': endpoint}
+
+    @staticmethod
+    def add(name: str, value: float = 1, **labels):
+        with Metrics.__lock:
+            key = (name, tuple(sorted(labels.items())))
+            Metrics.__counters[key] = Metrics.__counters.get(key, 0) + value
+        Metrics.write()
+
+    @staticmethod
+    def observe(response: requests.Response, *_, **__):
+        """Response hook of requests.Session, received bytes are counted as content is read (streamed or not)"""
+        labels, iter_content = Metrics.labels(response.request.url, response.request.body), response.iter_content
+        with Metrics.__lock:
+            key, seconds = tuple(sorted(labels.items())), response.elapsed.total_seconds()
+            buckets = Metrics.__histograms.setdefault(key, [0] * len(Metrics.BUCKETS) + [0.0])
+            buckets[bisect_left(Metrics.BUCKETS, seconds)] += 1
+            buckets[-1] += seconds
+        Metrics.add('wdpy_http_requests_total', status=str(response.status_code), **labels)
+        Metrics.add('wdpy_http_sent_bytes_total', len(response.request.body or ''), **labels)
+
+        def counted(*args, **kwargs):  # content, text, json() and iter_lines() are all based on iter_content()
+            for chunk in iter_content(*args, **kwargs):
+                Metrics.add('wdpy_http_received_bytes_total', len(chunk.encode() if isinstance(chunk, str) else chunk),
+                            **labels)
+                yield chunk
+
+        response.iter_content = counted
+
+    @staticmethod
+    def __format(labels) -> str:
+        return ','.join('{}="{}"'.format(key, value.replace('"', '\\"')) for key, value in labels)
+
+    @staticmethod
+    def write(force: bool = False):
+        with Metrics.__lock:
+            if not Metrics.path or not (force or Metrics.__written + Metrics.INTERVAL < time.time()):
+                return
+            Metrics.__written, lines = time.time(), []
+            for name in sorted({name for name, _ in Metrics.__counters}):
+                lines.append('# TYPE {} counter'.format(name))
+                for (n, labels), value in sorted(Metrics.__counters.items()):
+                    if n == name:
+                        lines.append('{}{{{}}} {}'.format(name, Metrics.__format(labels), value))
+            lines.append('# TYPE wdpy_http_request_seconds histogram')
+            for labels, buckets in sorted(Metrics.__histograms.items()):
+                for le, count in zip(Metrics.BUCKETS, itertools.accumulate(buckets[:-1])):
+                    lines.append('wdpy_http_request_seconds_bucket{{{},le="{}"}} {}'.format(
+                        Metrics.__format(labels), '+Inf' if le == math.inf else le, count))
+                lines.append('wdpy_http_request_seconds_sum{{{}}} {}'.format(Metrics.__format(labels), buckets[-1]))
+                lines.append('wdpy_http_request_seconds_count{{{}}} {}'.format(Metrics.__format(labels),
+                                                                               sum(buckets[:-1])))
+            try:  # metrics must never stop the bot
+                with open(Metrics.path + '.tmp', 'w') as file:
+                    file.write('\n'.join(lines) + '\n')
+                os.replace(Metrics.path + '.tmp', Metrics.path)
+            except OSError as e:
+                logging.warning('Cannot write {}: {}'.format(Metrics.path, e))
+
+
 class Wikidata:
     USER_AGENT = 'automated import by https://www.wikidata.org/wiki/User:Ghuron'
-    (__api := requests.Session()).headers.update({'User-Agent': USER_AGENT})
-    login, __password, __token = '', '', 'bad'
-    __types: dict[str, str] = None
+    TIMEOUT, CONNECTIONS, __sessions, __lock = (30, 600), 4, {}, threading.Lock()
+    MAX_QID, SLOW_QUERY = 2 ** 28, 50.0  # upper bound of item ids, WDQS aborts queries running longer than 60s
+    MIN_RANGE = 2 ** 16  # partitioned() does not split ranges of ids further (4096 queries at most)
+    login, __password, __token, throttle, __evicted, __auth = '', '', 'bad', Throttle(), False, threading.Lock()
+    STORAGE = os.environ.get('WDPY_STORAGE')  # folder for persistent caches between runs, disabled if not set
+    SERVER = os.environ.get('WDPY_SERVER')  # base url of stand_in.py to use instead of Wikibase API, WDQS and TAP
+    TYPES = ['wikibase-item', 'external-id', 'quantity', 'time', 'monolingualtext', 'string']  # codes of property types
+    __types, __newest, __type_stats = None, 0, Stats.counter('type_of')
     logging.basicConfig(format="%(asctime)s: %(levelname)s - %(message)s", stream=sys.stdout,
                         level=os.environ.get('LOGLEVEL', 'INFO').upper())
 
     @staticmethod
-    def request(url: str, session=requests.Session(), **kwargs):
+    def session(url: str) -> requests.Session:
+        """Keep-alive session shared by all requests to the host, no more than CONNECTIONS requests in parallel"""
+        with Wikidata.__lock:
+            if (host := urlparse(url).netloc) not in Wikidata.__sessions:
+                (session := requests.Session()).headers.update({'User-Agent': Wikidata.USER_AGENT})
+                Wikidata.__mount(session)
+                session.hooks['response'].append(Metrics.observe)
+                Wikidata.__sessions[host] = session
+            return Wikidata.__sessions[host]
+
+    @staticmethod
+    def __mount(session: requests.Session):
+        for prefix in ['https://', 'http://']:
+            session.mount(prefix, requests.adapters.HTTPAdapter(pool_maxsize=Wikidata.CONNECTIONS, pool_block=True))
+
+    @staticmethod
+    def reset():
+        """Drop connections inherited from the parent process (headers and cookies of the sessions are kept)"""
+        Wikidata.__lock = threading.Lock()
+        for session in Wikidata.__sessions.values():
+            Wikidata.__mount(session)
+
+    @staticmethod
+    def request(url: str, timeout=TIMEOUT, **kwargs):
+        """GET (or POST if kwargs provided) via shared session of the host, returns None in case of error"""
+        url = Wikidata.redirect(url)
         try:
             if len(kwargs):
-                if (response := session.post(url, **kwargs)).status_code != 200:
+                if (response := Wikidata.session(url).post(url, timeout=timeout, **kwargs)).status_code != 200:
                     logging.error('{} response: {} POST {}'.format(url, response.status_code, json.dumps(kwargs)))
                     return
-            elif (response := session.get(url)).status_code != 200:
+            elif (response := Wikidata.session(url).get(url, timeout=timeout)).status_code != 200:
                 logging.error('{} response: {}'.format(url, response.status_code))
                 return
             return response
         except requests.exceptions.RequestException as e:
+            Metrics.add('wdpy_http_errors_total', error=type(e).__name__, **Metrics.labels(url, kwargs.get('data')))
             logging.error('{} exception: {} POST {}'.format(url, e.__str__(), json.dumps(kwargs)))
 
+    @staticmethod
+    def redirect(url: str) -> str:
+        """Url of the stand-in server (if WDPY_SERVER is set) for Wikibase API, WDQS and TAP requests"""
+        if Wikidata.SERVER and ((parsed := urlparse(url)).netloc in ['www.wikidata.org', 'query.wikidata.org'] or
+                                parsed.path.endswith('/sync')):
+            return Wikidata.SERVER.rstrip('/') + parsed.path + ('?' + parsed.query if parsed.query else '')
+        return url
+
     @staticmethod
     def call(action: str, params: dict[str, str]) -> dict:
         """Wikidata API v1 call with JSON format, see https://wikidata.org/w/api.php"""
-        if result := Wikidata.request('https://www.wikidata.org/w/api.php', Wikidata.__api,
+        if result := Wikidata.request('https://www.wikidata.org/w/api.php',
                                       data={**params, 'format': 'json', 'action': action}):
             try:
-                return result.json()
+                if 'error' in (response := result.json()) and 'Retry-After' in result.headers:
+                    response['error']['retry-after'] = result.headers['Retry-After']
+                return response
             except json.decoder.JSONDecodeError:
                 logging.error('Cannot decode {} response for {}'.format(action, params))
 
@@ -61,12 +342,50 @@ class Wikidata:
         Wikidata.call('login', {'lgtoken': token, 'lgname': Wikidata.login, 'lgpassword': Wikidata.__password})
 
     @staticmethod
+    def storage(*path: str):
+        """Location in the persistent storage (with all parent folders created) or None if storage is disabled"""
+        if Wikidata.STORAGE:
+            os.makedirs(os.path.dirname(result := os.path.join(Wikidata.STORAGE, *path)), exist_ok=True)
+            return result
+
+    @staticmethod
+    def __stored(qid: str):
+        try:
+            with open(Wikidata.storage('entities', qid[-2:], qid + '.json')) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def __store(qid: str, entity: dict):
+        with open((path := Wikidata.storage('entities', qid[-2:], qid + '.json')) + '.tmp', 'w') as file:
+            json.dump(entity, file)
+        os.replace(path + '.tmp', path)
+
+    @staticmethod
+    @Stats.timed('load')
     def load(items: set[str]):
-        """Load up to 50 wikidata entities, returns None in case of error"""
+        """Load up to 50 wikidata entities, returns None in case of error. When persistent storage is enabled, only
+        lastrevid of items is requested, and full entity is downloaded only if it was modified since last load"""
         if len(items) > 0:
-            result = Wikidata.call('wbgetentities',
-                                   {'props': 'claims|info|labels|aliases', 'ids': '|'.join(sorted(items))})
-            return result['entities'] if (result is not None) and ('entities' in result) else None
+            result, items = {}, set(items)
+            if Wikidata.STORAGE and (info := Wikidata.call('wbgetentities', {'props': 'info', 'ids': '|'.join(
+                    sorted(items))})) and ('entities' in info):
+                for qid, entity in info['entities'].items():
+                    if 'lastrevid' in entity and (stored := Wikidata.__stored(qid)):
+                        if stored.get('lastrevid') == entity['lastrevid']:
+                            result[qid] = stored
+                            items.discard(qid)
+            if items:
+                loaded = Wikidata.call('wbgetentities', {'props': 'claims|info|labels|aliases', 'ids': '|'.join(
+                    sorted(items))})
+                if (loaded is None) or ('entities' not in loaded):
+                    return None
+                for qid, entity in loaded['entities'].items():
+                    if Wikidata.STORAGE and 'lastrevid' in entity:
+                        Wikidata.__store(qid, entity)
+                    result[qid] = entity
+            return result
 
     @staticmethod
     def search(query: str):
@@ -78,45 +397,199 @@ class Wikidata:
 
     @staticmethod
     def edit(data, method):
+        """Perform edit, pace is controlled by Wikidata.throttle based on maxlag errors and Retry-After header"""
         for retries in range(1, 3):
-            if response := Wikidata.call(method, {**data, 'maxlag': '15', 'token': Wikidata.__token}):
+            if retries > 1:
+                Metrics.add('wdpy_http_retries_total', host='www.wikidata.org', endpoint='/w/api.php?action=' + method)
+            with Wikidata.throttle:
+                response = Wikidata.call(method, {**data, 'maxlag': '15', 'token': (token := Wikidata.__token)})
+            if response:
                 if 'error' not in response:
-                    time.sleep(0.5)
+                    Wikidata.throttle.success()
                     return response
                 if response['error']['code'] == 'badtoken':
-                    Wikidata.__token = Wikidata.call('query', {'meta': 'tokens'})['query']['tokens']['csrftoken']
+                    Wikidata.__authenticate(token)
+                    continue
+                if response['error']['code'] == 'maxlag':
+                    Wikidata.throttle.lagged(float(response['error'].get('retry-after', 5)))
                     continue
                 logging.error('{} response: {}'.format(method, response['error']['info']))
-            time.sleep(10)
-            if response and (response['error']['code'] != 'maxlag'):
-                Wikidata.logon()  # just in case - re-authenticate
-
-    @staticmethod
-    def query(sparql: str, process=lambda row, result: (row[0], row[1])):
-        result = None
-        with requests.Session() as session:
-            session.headers.update({'Accept': 'text/csv', 'User-Agent': Wikidata.USER_AGENT})
-            if request := Wikidata.request('https://query.wikidata.org/sparql',
-                                           session, data={'query': sparql}, stream=True):
-                with closing(request) as r:
-                    reader = csv.reader(r.iter_lines(decode_unicode='utf-8'), delimiter=',', quotechar='"')
-                    next(reader)
-                    result = {}
-                    for line in reader:
-                        if len(line := [item.replace('http://www.wikidata.org/entity/', '') for item in line]) > 1:
-                            key, value = process(line, result)
-                            result[key] = value
+            if response is None or response['error']['code'].startswith(Throttle.TRANSIENT):
+                Wikidata.throttle.failed()  # error specific to the edited item does not slow down others
+            if response:
+                Wikidata.__authenticate(token, relogon=True)  # just in case
+
+    @staticmethod
+    def __authenticate(token: str, relogon: bool = False):
+        """Obtain new csrf token (after re-logon if requested), unless other edit thread did it since token was used"""
+        with Wikidata.__auth:
+            if Wikidata.__token == token:
+                if relogon:
+                    Wikidata.logon()
+                if (response := Wikidata.call('query', {'meta': 'tokens'})) and 'query' in response:
+                    Wikidata.__token = response['query']['tokens']['csrftoken']
+
+    @staticmethod
+    def csv(url: str, ttl: int = None, **kwargs):
+        """csv.reader over the response of POST request or None in case of error. If ttl (in seconds) is provided,
+        response is kept in persistent storage (in folder named by ttl, addressed by hash of url and request) and reused
+        until expired"""
+        path = None
+        if ttl and (key := hashlib.sha1(json.dumps([url, kwargs], sort_keys=True).encode()).hexdigest()):
+            Wikidata.__evict()
+            if (path := Wikidata.storage('query', str(ttl), key + '.csv')) and os.path.exists(path):
+                if os.path.getmtime(path) + ttl > time.time():
+                    return csv.reader(Wikidata.__read_lines(path), delimiter=',', quotechar='"')
+        if response := Wikidata.request(url, stream=True, **kwargs):
+            return csv.reader(Wikidata.__stream_lines(response, path), delimiter=',', quotechar='"')
+
+    @staticmethod
+    def __evict():
+        """Once per run remove expired responses from persistent storage, folder name is their ttl"""
+        if Wikidata.__evicted or not (root := Wikidata.storage('query', '')):
+            return
+        Wikidata.__evicted, now = True, time.time()
+        for entry in os.scandir(root):
+            try:
+                if not entry.is_dir():  # left by interrupted run or previous version
+                    os.remove(entry.path)
+                elif entry.name.isdigit():
+                    for file in os.scandir(entry.path):
+                        if file.stat().st_mtime + int(entry.name) < now:
+                            os.remove(file.path)
+            except OSError as e:
+                logging.warning('Cannot evict {}: {}'.format(entry.path, e))
+
+    @staticmethod
+    def __read_lines(path: str):
+        with open(path, encoding='utf-8') as file:
+            for line in file:
+                yield line.rstrip('\n')
+
+    @staticmethod
+    def __stream_lines(response, path: str = None):
+        """Yields lines of the response, saving them into path once response is completely read"""
+        with closing(response) as r, open(path + '.tmp', 'w', encoding='utf-8') if path else nullcontext() as file:
+            for line in r.iter_lines(decode_unicode='utf-8'):
+                if file:
+                    file.write(line + '\n')
+                yield line
+        if path:
+            os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def __decode(row: list[str]) -> list[str]:
+        return [cell[31:] if cell.startswith('http://www.wikidata.org/entity/') else cell for cell in row]
+
+    @staticmethod
+    def rows(sparql: str, ttl: int = None):
+        """Lazy iterator over SPARQL query result rows (header skipped, entity prefix removed), None in case of error"""
+        if reader := Wikidata.csv('https://query.wikidata.org/sparql', ttl, data={'query': sparql},
+                                  headers={'Accept': 'text/csv'}):
+            next(reader, None)
+            return map(Wikidata.__decode, reader)
+
+    @staticmethod
+    def query(sparql: str, process=lambda row, result: (row[0], row[1]), ttl: int = None, result=None):
+        """Dictionary of (key, value) returned by process(row, result) for every row of SPARQL query result or None
+        in case of error. If result is provided, rows are added to it in place (rows it rejects are skipped)"""
+        if (rows := Wikidata.rows(sparql, ttl)) is None:
+            return None
+        result = {} if result is None else result
+        for row in rows:
+            if len(row) > 1:
+                key, value = process(row, result)
+                try:
+                    result[key] = value
+                except ValueError:
+                    logging.warning('Skipped {} -> {} of {}'.format(key, value, ' '.join(sparql.split())))
         return result
 
     @staticmethod
-    def type_of(property_id: str) -> str:
-        """Lazy load and read-only access to type of the property"""
+    def partitioned(sparql: str, variable: str = '?i', process=lambda row, result: (row[0], row[1]), ttl: int = None,
+                    result=None, parts: int = 1):
+        """Same as query(), but executed as `parts` parallel queries over ranges of numeric id of `variable` item, so
+        that huge enumeration needs no OFFSET. Range, which query timed out, is split in halves and queried again,
+        None is returned if it is already as narrow as MIN_RANGE"""
+        result, condition = {} if result is None else result, ' FILTER(xsd:integer(STRAFTER(STR({0}), "/entity/Q"))' + \
+            ' >= {1} && xsd:integer(STRAFTER(STR({0}), "/entity/Q")) < {2})'
+
+        def run(low: int, high: int, into: dict) -> tuple:
+            query, started = sparql, time.time()
+            if high - low < Wikidata.MAX_QID:
+                query = sparql[:(at := sparql.rindex('}'))] + condition.format(variable, low, high) + sparql[at:]
+            try:
+                into = Wikidata.query(query, process, ttl, into)
+            except requests.exceptions.RequestException:  # response was interrupted
+                into = None
+            return low, high, into, time.time() - started > Wikidata.SLOW_QUERY
+
+        with ThreadPoolExecutor(Wikidata.CONNECTIONS) as pool:
+            size = -(-Wikidata.MAX_QID // parts)
+            futures = {pool.submit(run, low, low + size, result if parts == 1 else type(result)())
+                       for low in range(0, Wikidata.MAX_QID, size)}
+            while futures:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for low, high, rows, timeout in [future.result() for future in done]:
+                    if rows is not None and rows is not result:
+                        result.update(rows)
+                    elif rows is None and timeout and high - low > Wikidata.MIN_RANGE:
+                        logging.info('Split query of ids from {} to {}'.format(low, high))
+                        mid, empty = (low + high) // 2, type(result)
+                        futures |= {pool.submit(run, low, mid, empty()), pool.submit(run, mid, high, empty())}
+                    elif rows is None:
+                        logging.error('Query of ids from {} to {} failed'.format(low, high))
+                        pool.shutdown(wait=False, cancel_futures=True)
+                        return None
+        return result
+
+    @staticmethod
+    def __load_types(refresh: bool = False):
+        """Read versioned snapshot {property: index in TYPES} and query WDQS only for properties created since"""
         if Wikidata.__types is None:
-            Wikidata.__types = Wikidata.query('SELECT ?prop ?type { ?prop wikibase:propertyType ?type }')
-            for prop in Wikidata.__types:
-                Wikidata.__types[prop] = Wikidata.__types[prop].replace('http://wikiba.se/ontology#', ''). \
-                    replace('WikibaseItem', 'wikibase-item').replace('ExternalId', 'external-id').lower()
-        return Wikidata.__types[property_id] if property_id in Wikidata.__types else None
+            Wikidata.__types, updated = {}, 0
+            try:
+                with open(Wikidata.storage('property_types.json')) as file:
+                    if (snapshot := json.load(file))['version'] == 1:
+                        Wikidata.TYPES, Wikidata.__types, updated = snapshot['types'], snapshot['codes'], snapshot['at']
+            except (OSError, TypeError, ValueError, KeyError):
+                pass
+            Wikidata.__newest = max([int(p[1:]) for p in Wikidata.__types], default=0)
+            refresh = refresh or (updated + (Model.config('ttl', 'type_of') or 0) < time.time())
+        if refresh:
+            sparql = 'SELECT ?prop ?type {{ ?prop wikibase:propertyType ?type ' + \
+                     'FILTER(xsd:integer(STRAFTER(STR(?prop), "/entity/P")) > {}) }}'
+            for prop, name in (Wikidata.query(sparql.format(Wikidata.__newest)) or {}).items():
+                name = name.replace('http://wikiba.se/ontology#', '').replace('WikibaseItem', 'wikibase-item'). \
+                    replace('ExternalId', 'external-id').lower()
+                if name not in Wikidata.TYPES:
+                    Wikidata.TYPES.append(name)
+                Wikidata.__types[prop] = Wikidata.TYPES.index(name)
+                Wikidata.__newest = max(Wikidata.__newest, int(prop[1:]))
+            if path := Wikidata.storage('property_types.json'):
+                with open(path + '.tmp', 'w') as file:
+                    json.dump({'version': 1, 'at': time.time(), 'types': Wikidata.TYPES, 'codes': Wikidata.__types},
+                              file, separators=(',', ':'))
+                os.replace(path + '.tmp', path)
+
+    @staticmethod
+    def type_code(property_id: str):
+        """Index of the property type in Wikidata.TYPES or None. Snapshot of property types is loaded on first call and
+        refreshed if an unknown property is newer than all known properties"""
+        if Wikidata.__types is None:
+            Wikidata.__load_types()
+        Wikidata.__type_stats[(code := Wikidata.__types.get(property_id)) is None] += 1
+        if code is None and property_id and re.fullmatch('P\\d+', property_id):
+            if int(property_id[1:]) > Wikidata.__newest:
+                Wikidata.__load_types(refresh=True)
+                Wikidata.__newest = max(Wikidata.__newest, int(property_id[1:]))  # do not try again for older ones
+                return Wikidata.__types.get(property_id)
+        return code
+
+    @staticmethod
+    def type_of(property_id: str) -> str:
+        """Read-only access to type of the property"""
+        return None if (code := Wikidata.type_code(property_id)) is None else Wikidata.TYPES[code]
 
     @staticmethod
     def format_float(figure, digits: int = -1):
@@ -198,17 +671,17 @@ class Wikidata:
     def create_value(property_id: str, value, lower: str = None, upper: str = None):
         if value is None or value is None or value == '' or value == 'NaN':
             return
-        if property_id is None or Wikidata.type_of(property_id) is None:
+        if property_id is None or (property_type := Wikidata.type_of(property_id)) is None:
             return
-        if Wikidata.type_of(property_id) == 'time':
+        if property_type == 'time':
             return Wikidata.parse_date(value)
-        if Wikidata.type_of(property_id) == 'monolingualtext':
+        if property_type == 'monolingualtext':
             return {'text': value, 'language': 'en'}
-        if Wikidata.type_of(property_id) == 'wikibase-item':
+        if property_type == 'wikibase-item':
             if not re.search('Q\\d+$', value):
                 return
             return {'entity-type': 'item', 'id': value}
-        if Wikidata.type_of(property_id) == 'quantity':
+        if property_type == 'quantity':
             try:
                 result = {'amount': Wikidata.format_float(value), 'unit': '1'}
                 if upper is not None and lower is not None:
@@ -304,6 +777,31 @@ class Claim:
     def save(self, summary):
         Wikidata.edit(data={'summary': summary, 'claim': json.dumps(self.claim)}, method='wbsetclaim')
 
+    _pending = {}
+
+    def save_later(self, summary: str):
+        """Postpone save() until flush(), so that all pending claims of the same item are written with one edit"""
+        Claim._pending.setdefault(self.claim['id'].split('$')[0].upper(), []).append((self, summary))
+
+    @staticmethod
+    def flush():
+        """Write pending claims with single wbeditentity per item, fallback to wbsetclaim per claim if it fails.
+        Different items are written concurrently, as many at a time as Wikidata.throttle window allows"""
+        pending, Claim._pending = Claim._pending, {}
+        with ThreadPoolExecutor(Throttle.MAX_WINDOW) as pool:
+            list(pool.map(lambda item: Claim.__write(*item), pending.items()))
+
+    @staticmethod
+    def __write(qid: str, claims: list):
+        if len(claims) > 1:
+            summary = '; '.join(dict.fromkeys(summary for _, summary in claims))
+            data = {'id': qid, 'summary': summary if len(summary) <= 500 else summary[:497] + '...',
+                    'data': json.dumps({'claims': [claim.claim for claim, _ in claims]})}
+            if Wikidata.edit(data, 'wbeditentity'):
+                return
+        for claim, summary in claims:
+            claim.save(summary)
+
     def check_if_no_refs(self, property_id: str, db_ref: str) -> set[str]:
         result = set()
         if 'references' in self.claim:
@@ -318,6 +816,7 @@ class Claim:
     def preload(cls, qids: set[str]):
         """Returns True if all loaded successfully"""
         for qid in list(qids):
+            Stats.hit('_pub_dates', qid in Claim._pub_dates)
             if qid in Claim._pub_dates:
                 qids.remove(qid)
 
@@ -402,13 +901,82 @@ class Claim:
                     self.claim['rank'] = 'normal'
 
 
+class QidMap(MutableMapping):
+    """Memory-efficient replacement of dict for external id -> qid (or None) caches: keys are kept in sorted list and
+    numbers of qids in parallel array (0 for None, -1 for deleted), new keys are buffered in small dict until merge"""
+
+    def __init__(self, items=()):
+        self.__keys, self.__values, self.__recent, self.__deleted = [], array('i'), {}, 0
+        self.update(items)
+
+    def __find(self, key) -> int:
+        if (idx := bisect_left(self.__keys, key)) < len(self.__keys) and self.__keys[idx] == key:
+            return idx
+        return -1
+
+    def __merge(self):
+        if self.__deleted:
+            self.__keys = list(itertools.compress(self.__keys, alive := [v >= 0 for v in self.__values]))
+            self.__values = array('i', itertools.compress(self.__values, alive))
+        keys, values, start = [], array('i'), 0
+        for key in sorted(self.__recent):
+            keys += self.__keys[start:(idx := bisect_left(self.__keys, key, start))]
+            values += self.__values[start:idx]
+            keys.append(key)
+            values.append(self.__recent[key])
+            start = idx
+        keys += self.__keys[start:]
+        values += self.__values[start:]
+        self.__keys, self.__values, self.__recent, self.__deleted = keys, values, {}, 0
+
+    def __getitem__(self, key):
+        if (value := self.__recent.get(key, -1)) < 0 and (idx := self.__find(key)) >= 0:
+            value = self.__values[idx]
+        if value < 0:
+            raise KeyError(key)
+        return 'Q' + str(value) if value else None
+
+    def __contains__(self, key):
+        return key in self.__recent or ((idx := self.__find(key)) >= 0 and self.__values[idx] >= 0)
+
+    def __setitem__(self, key, qid):
+        if qid and not (qid[0] == 'Q' and qid[1:].isdigit() and int(qid[1:]) < 2 ** 31):
+            raise ValueError(qid)
+        value = int(qid[1:]) if qid else 0
+        if key in self.__recent or (idx := self.__find(key)) < 0:
+            self.__recent[key] = value
+            if len(self.__recent) > max(1024, len(self.__keys) // 2):
+                self.__merge()
+        else:
+            if self.__values[idx] < 0:  # was deleted
+                self.__deleted -= 1
+            self.__values[idx] = value
+
+    def __delitem__(self, key):
+        if key in self.__recent:
+            del self.__recent[key]
+        elif (idx := self.__find(key)) >= 0 and self.__values[idx] >= 0:
+            self.__values[idx], self.__deleted = -1, self.__deleted + 1
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        """Keys in sorted order"""
+        if self.__recent or self.__deleted:
+            self.__merge()
+        return iter(self.__keys)
+
+    def __len__(self):
+        return len(self.__keys) - self.__deleted + len(self.__recent)
+
+
 class Element:
-    __cache, property_id, db_ref = {}, None, None
+    __cache, property_id, db_ref, _prefetched, _statements = {}, None, None, {}, {}
     SINGLE_VALUE = {'P50': 'P1545', 'P1215': 'P1227', 'P1476': '', 'P2093': 'P1545', 'P6257': '', 'P6258': '',
                     'P6259': ''}
 
     def __init__(self, external_id: str, qid: str = None):
-        self.external_id, self.qid = external_id, qid
+        self.external_id, self.qid, self._started = external_id, qid, time.time()
         self._entity, self._original, self._affected, self._queue = None, {}, set(), []
         if qid or (qid := self.get_qid()):  # There is a chance to find qid down the road
             self.set_qid(qid)
@@ -420,6 +988,7 @@ class Element:
 
     def get_qid(self):
         try:
+            Stats.hit('get_cache', self.external_id in self.get_cache())
             if self.external_id in self.get_cache():
                 return self.get_cache()[self.external_id]
             elif qid := self.haswbstatement(self.external_id):
@@ -434,7 +1003,9 @@ class Element:
     def entity(self):
         if not self._entity:
             self._entity = {'labels': {}, 'claims': {}}
-            if self.qid and (result := Wikidata.load({self.qid})):
+            if self.qid in Element._prefetched:
+                self._entity = Element._prefetched.pop(self.qid)
+            elif self.qid and (result := Wikidata.load({self.qid})):
                 self._entity = result[self.qid]
             self.save_checkpoint()
         return self._entity
@@ -568,6 +1139,13 @@ class Element:
         return 'batch import from [[' + self.db_ref + ']] for object ' + self.external_id
 
     def save(self):
+        try:
+            with Stats.phase('save'):
+                return self.__save()
+        finally:
+            Stats.item(self.external_id, time.time() - self._started)
+
+    def __save(self):
         if not self.was_modified_since_checkpoint():
             return
 
@@ -580,6 +1158,7 @@ class Element:
         else:
             data['new'] = 'item'
 
+        Element._prefetched.pop(self.qid, None)  # do not reuse outdated version
         if response := Wikidata.edit(data, 'wbeditentity'):
             if 'nochange' not in response['entity']:
                 self.set_qid(response['entity']['id'])
@@ -601,9 +1180,12 @@ class Element:
                 self.set_qid(qid)
 
         if self.qid is None:
+            identifiers = [(snak['property'], snak['datavalue']['value']) for snak in parsed_data.input_snaks if (
+                    snak['datatype'] == 'external-id') and (snak['property'] != self.property_id)]
+            resolved = self.resolve(identifiers) if len(identifiers) > 1 else {}
             for snak in parsed_data.input_snaks:
                 if (snak['datatype'] == 'external-id') and (snak['property'] != self.property_id):
-                    if qid := self.haswbstatement(snak['datavalue']['value'], snak['property']):
+                    if qid := self.haswbstatement(snak['datavalue']['value'], snak['property'], resolved):
                         self.set_qid(qid)
                         break
             if self.qid is None:
@@ -624,40 +1206,89 @@ class Element:
             return {}  # No further modification is possible
 
         for property_id in self._affected:
-            if Wikidata.type_of(property_id) == 'external-id':
+            if (property_type := Wikidata.type_of(property_id)) == 'external-id':
                 continue
 
             self._process_mespos(property_id)
             if property_id in Element.SINGLE_VALUE:
                 self.remove_all_but_one(property_id, Element.SINGLE_VALUE[property_id])
-            elif Wikidata.type_of(property_id) in ['quantity', 'string', 'monolingualtext'] and property_id != 'P528':
+            elif property_type in ['quantity', 'string', 'monolingualtext'] and property_id != 'P528':
                 self.deprecate_all_but_one(property_id)
             elif property_id == 'P577':
                 self.deprecate_all_but_one(property_id)
 
     @classmethod
-    def haswbstatement(cls, external_id: str, property_id: str = None) -> str:
+    def haswbstatement(cls, external_id: str, property_id: str = None, resolved: dict = None) -> str:
         """
         :param external_id: unique external data source identifier
         :param property_id: property identifier if non-default for the model
+        :param resolved: result of resolve() to consume, by default the one of current prefetch() batch
         :return: wikidata item identifier or None
         :raises ValueError when more than 1 result found
         """
         if external_id and (property_id := property_id if property_id else cls.property_id):
+            resolved = Element._statements if resolved is None else resolved
+            if (property_id, external_id) in resolved:  # already resolved by resolve()
+                if isinstance(result := resolved.pop((property_id, external_id)), int):
+                    raise ValueError(result)
+                return result
             return Wikidata.search('haswbstatement:"{}={}"'.format(property_id, external_id))
 
+    @staticmethod
+    def resolve(statements, size: int = 200) -> dict:
+        """Look up items for (property_id, value) pairs with one SPARQL query per `size` of them, result is to be passed
+        to subsequent haswbstatement() calls. Pairs of failed queries are absent in the result"""
+        sparql = 'SELECT ?p ?c ?i {{ VALUES (?p ?c) {{ {} }} ?p wikibase:claim ?pc; wikibase:statementProperty ?ps.' + \
+                 ' ?i ?pc [?ps ?c] }}'
+        statements, result = iter(set(filter(lambda x: x[0] and x[1], statements))), {}
+        while batch := list(itertools.islice(statements, size)):
+            values = ' '.join('(wd:{} {})'.format(p, json.dumps(value, ensure_ascii=False)) for p, value in batch)
+            if (rows := Wikidata.rows(sparql.format(values))) is not None:
+                found = {}
+                for row in rows:
+                    found.setdefault((row[0], row[1]), set()).add(row[2])
+                for key in batch:
+                    qids = found.get(key, set())
+                    result[key] = (qids.pop() if len(qids) == 1 else len(qids)) if qids else None
+        return result
+
+    @classmethod
+    def prefetch(cls, external_ids, size: int = 50):
+        """Iterate over external_ids, loading entities for every `size` of them with a single wbgetentities call.
+        Entities (and resolved primary cache misses) are dropped once used, unused ones are kept till the batch after
+        next, as consumer might lag behind"""
+        external_ids, previous, stale = iter(external_ids), (set(), {}), (set(), {})
+        while batch := list(itertools.islice(external_ids, size)):
+            qids = set(filter(lambda x: isinstance(x, str), [cls.get_cache().get(_id) for _id in batch]))
+            misses = [(cls.property_id, _id) for _id in batch if _id not in cls.get_cache()] if cls.property_id else []
+            resolved = cls.resolve(misses)  # all primary cache misses at once
+            for qid in stale[0]:  # keep at most two batches in memory
+                Element._prefetched.pop(qid, None)
+            for key in stale[1]:
+                Element._statements.pop(key, None)
+            Element._statements.update(resolved)
+            stale, previous = previous, (qids, resolved)
+            for qid, entity in (result if qids and (result := Wikidata.load(qids)) else {}).items():
+                if 'missing' not in entity:
+                    Element._prefetched[qid] = entity
+            yield from batch
+
     @classmethod
     def get_cache(cls, reset=None) -> dict:
         if reset is not None:
             cls.__cache = reset
         elif cls.__cache is None:
             sparql = 'SELECT ?c ?i {{ ?i p:{0}/ps:{0} ?c }}'.format(cls.property_id)
-            cls.__cache = result if (result := Wikidata.query(sparql)) else {}
+            ttl = Model.config('ttl', 'get_cache')
+            cls.__cache = Wikidata.partitioned(sparql, ttl=ttl, result=QidMap()) or QidMap()
         return cls.__cache
 
 
 class Model:
-    property, db_ref, _config, item = None, None, {}, Element
+    property, db_ref, _config, item, _checkpoint, _done = None, None, {}, Element, None, None
+    WORKERS, __pool, __prepared = int(os.environ.get('WDPY_WORKERS', '0')), None, {}  # processes for prepare_data
+    QUEUED, __pending = 4, iter(())  # ids submitted ahead of get_by_id() per worker, ids not submitted yet
+    _deferred = None  # None in main process, True in forked worker once prepared data needs an item to be created
 
     @classmethod
     def initialize(cls: Model, file_name: str) -> bool:
@@ -671,8 +1302,52 @@ class Model:
 
         if need_init := (sys.argv[0].endswith(os.path.basename(file_name)) and not Wikidata.login):
             Wikidata.logon(sys.argv[1], sys.argv[2])
+            atexit.register(Stats.dump, name := os.path.splitext(os.path.basename(file_name))[0])
+            Metrics.path = Wikidata.storage('metrics', name + '.prom')  # None if storage is disabled
+            atexit.register(Metrics.write, True)
+            cls._checkpoint = Wikidata.storage('checkpoint', name)
         return need_init
 
+    @classmethod
+    def checkpoint(cls, cursor):
+        """Persist position of the chunk about to be processed (None once harvest is complete) and forget ids processed
+        within previous chunk. First call returns position of the chunk interrupted in previous run (if not expired)"""
+        if cls._checkpoint is None:
+            return cursor
+        if cls._done is None:
+            try:
+                if os.path.getmtime(cls._checkpoint + '.json') + (cls.config('ttl', 'checkpoint') or 0) > time.time():
+                    with open(cls._checkpoint + '.json') as file:
+                        cursor = json.load(file)['cursor']
+                    with open(cls._checkpoint + '.done', encoding='utf-8') as file:
+                        cls._done = set(file.read().splitlines())
+                    logging.info('Resume from {} with {} items already processed'.format(cursor, len(cls._done)))
+                    return cursor
+            except (OSError, ValueError, KeyError):
+                pass
+        cls._done = set()
+        if cursor is None:
+            for suffix in ['.json', '.done']:
+                if os.path.exists(cls._checkpoint + suffix):
+                    os.remove(cls._checkpoint + suffix)
+            return cursor
+        with open(cls._checkpoint + '.done', 'w'), open(cls._checkpoint + '.json.tmp', 'w') as file:
+            json.dump({'cursor': cursor}, file)
+        os.replace(cls._checkpoint + '.json.tmp', cls._checkpoint + '.json')
+        return cursor
+
+    @classmethod
+    def pending(cls, external_ids, prefetch: bool = True):
+        """Ids that were not processed in current chunk before interruption (optionally prefetched), every id is
+        recorded as processed when the next one is requested"""
+        external_ids = (_id for _id in external_ids if not cls._done or _id not in cls._done)
+        for external_id in cls.item.prefetch(external_ids) if prefetch else external_ids:
+            yield external_id
+            if cls._done is not None and cls._checkpoint:
+                cls._done.add(external_id)
+                with open(cls._checkpoint + '.done', 'a', encoding='utf-8') as file:
+                    file.write(external_id + '\n')
+
     @classmethod
     def config(cls, *kwargs):
         # returns requested setting or None
@@ -711,11 +1386,71 @@ class Model:
     def prepare_data(cls, external_id: str):
         return cls(external_id)
 
+    @classmethod
+    def prepare_parallel(cls, external_ids):
+        """Fork WORKERS processes (if more than 1) with current state of the model and run prepare_data() for
+        external_ids there, no more than QUEUED per worker ahead of get_by_id(), which picks up results. Ones not used
+        till the next call are discarded. Workers never edit wikidata: data referring to items that have to be created
+        is prepared again by get_by_id(), as well as data of failed workers"""
+        if Model.__pool:
+            Model.__pool.shutdown(wait=False, cancel_futures=True)
+            Model.__pool, Model.__prepared, Model.__pending = None, {}, iter(())
+        if Model.WORKERS > 1:
+            Model.__pool = ProcessPoolExecutor(Model.WORKERS, multiprocessing.get_context('fork'), Wikidata.reset)
+            Model.__pending = ((cls, _id) for _id in external_ids if not cls._done or _id not in cls._done)
+            Model.__submit()
+
+    @staticmethod
+    def __submit():
+        for key in itertools.islice(Model.__pending, max(0, Model.WORKERS * Model.QUEUED - len(Model.__prepared))):
+            Model.__prepared[key] = Model.__pool.submit(key[0].prepare_forked, key[1])
+
+    @classmethod
+    def __prepared_data(cls, external_id: str) -> tuple:
+        """(data, whether it has to be prepared by main process), following ids are submitted to workers meanwhile"""
+        if (cls, external_id) not in Model.__prepared:
+            return None, True
+        while (key := next(iter(Model.__prepared))) != (cls, external_id):  # ids submitted earlier were skipped
+            Model.__prepared.pop(key).cancel()
+        future = Model.__prepared.pop(key)
+        try:
+            return future.result()
+        except BrokenProcessPool as e:  # worker was killed, the rest is prepared by main process
+            logging.error('Parallel preparation stopped: {}'.format(e))
+            Model.__pool.shutdown(wait=False, cancel_futures=True)
+            Model.__pool, Model.__prepared, Model.__pending = None, {}, iter(())
+        except Exception as e:
+            logging.warning('Worker failed to prepare "{}": {}'.format(external_id, e))
+        finally:
+            if Model.__pool:
+                Model.__submit()
+        return None, True
+
+    @classmethod
+    def prepare_forked(cls, external_id: str) -> tuple:
+        """(prepare_data() result, whether it has to be prepared again by main process) within forked worker"""
+        Model._deferred = False
+        return cls.prepare_data(external_id), Model._deferred
+
+    @classmethod
+    def get_or_create(cls, external_id: str) -> Element:
+        """Item of external_id, created if missing. Forked worker returns item without qid and defers data instead"""
+        if Model._deferred is not None and (instance := cls.item(external_id)).has_to_be_created():
+            Model._deferred = True
+            return instance
+        (instance := cls.get_by_id(external_id)).save()
+        return instance
+
     @classmethod
     def get_by_id(cls, external_id: str, forced: bool = False) -> Element:
         """Attempt to find qid by external_id or create it"""
         if (instance := cls.item(external_id)).has_to_be_created() or forced:
-            instance.apply(cls.prepare_data(external_id))
+            with Stats.phase('prepare_data'):
+                data, deferred = cls.__prepared_data(external_id)
+                if deferred:  # not prepared by worker or it needs items to be created
+                    data = cls.prepare_data(external_id)
+            with Stats.phase('apply'):
+                instance.apply(data)
         return instance
 
     def get_qid(self):
@@ -745,7 +1480,8 @@ class AstroItem(Element):
             tla = coordinates.SkyCoord(ra, dec, frame='icrs', unit='deg').get_constellation(short_name=True)
             if AstroItem.__const is None:
                 AstroItem.__const = Wikidata.query(
-                    'SELECT DISTINCT ?n ?i {?i wdt:P31/wdt:P279* wd:Q8928; wdt:P1813 ?n}')
+                    'SELECT DISTINCT ?n ?i {?i wdt:P31/wdt:P279* wd:Q8928; wdt:P1813 ?n}',
+                    ttl=Model.config('ttl', 'constellations'))
             target = None
             for claim in list(self.entity['claims']['P59'] if 'P59' in self.entity['claims'] else []):
                 if target or (claim['mainsnak']['datavalue']['value']['id'] != AstroItem.__const[tla]):
@@ -759,15 +1495,53 @@ class AstroItem(Element):
 
 
 class Article(Element):
+    DOI_TTL, _dois = {True: 365 * 86400, False: 7 * 86400}, None  # how long existing/missing DOI can be trusted
+
     def obtain_claim(self, snak: dict):
         if snak['property'] == 'P356':
-            session = requests.Session()
-            session.headers.update({'User-Agent': Wikidata.USER_AGENT})
-            if Wikidata.request('https://doi.org/' + snak['datavalue']['value'], session) is None:
+            if (doi := snak['datavalue']['value'].upper()) not in Article.check_doi({doi}):
                 return
-            snak['datavalue']['value'] = snak['datavalue']['value'].upper()
+            snak['datavalue']['value'] = doi
         return super().obtain_claim(snak)
 
+    @staticmethod
+    def __resolve(doi: str):
+        """True if DOI is registered, False if not and None if doi.org cannot tell right now"""
+        try:
+            url = 'https://doi.org/api/handles/' + quote(doi)
+            return {200: True, 404: False}.get(Wikidata.session(url).get(url, timeout=Wikidata.TIMEOUT).status_code)
+        except requests.exceptions.RequestException as e:
+            logging.error('Cannot check {}: {}'.format(doi, e.__str__()))
+
+    @staticmethod
+    def check_doi(dois) -> set[str]:
+        """Returns existing DOIs among provided (empty ones are ignored). DOIs that were not checked recently are
+        resolved in parallel and results are appended to doi.tsv in persistent storage"""
+        if Article._dois is None:
+            Article._dois = {}
+            try:
+                with open(Wikidata.storage('doi.tsv')) as file:
+                    for doi, exists, timestamp in map(lambda line: line.rstrip('\n').split('\t'), file):
+                        Article._dois[doi] = (exists == '1', float(timestamp))
+            except (OSError, TypeError, ValueError):
+                pass
+
+        now, dois = time.time(), {doi.upper() for doi in dois if doi}
+        if pending := [d for d in dois if d not in Article._dois or Article._dois[d][1] + Article.DOI_TTL[
+                Article._dois[d][0]] < now]:
+            if len(pending) == 1:  # single snak of obtain_claim(), not worth starting a pool
+                checked = [(pending[0], Article.__resolve(pending[0]))]
+            else:
+                with ThreadPoolExecutor(Wikidata.CONNECTIONS) as executor:
+                    checked = list(zip(pending, executor.map(Article.__resolve, pending)))
+            checked = [(doi, exists, now) for doi, exists in checked if exists is not None]
+            for doi, exists, timestamp in checked:
+                Article._dois[doi] = (exists, timestamp)
+            if checked and (path := Wikidata.storage('doi.tsv')):
+                with open(path, 'a') as file:
+                    file.writelines('{}\t{:d}\t{}\n'.format(d, e, t) for d, e, t in checked)
+        return {d for d in dois if d in Article._dois and Article._dois[d][0]}
+
     def post_process(self):
         super().post_process()
         self.sort_authors('P2093', self.sort_authors('P50', []))
@@ -789,21 +1563,28 @@ class AstroModel(Model):
     _dataset, item, _ADQL_WRAPPER = {}, AstroItem, 'SELECT * FROM ({}) a WHERE {}'
 
     @classmethod
-    def load(cls, condition=None) -> dict:
-        result = {}
-        for lines in cls.config('queries'):
-            query = ''.join(lines)
-            if condition:
-                query = cls._ADQL_WRAPPER.format(query, condition)
-            cls.query(cls.config('endpoint'), query, result)
+    def load(cls, condition=None, cache: bool = True) -> dict:
+        """Rows of all configured queries grouped by object or None if any query failed, queries are executed
+        concurrently. Results of single-use queries (cache=False) are not kept in persistent storage"""
+        queries = [cls._ADQL_WRAPPER.format(query, condition) if condition else query
+                   for query in map(''.join, cls.config('queries'))]
+        ttl = cls.config('ttl', 'queries') if cache else None
+        with ThreadPoolExecutor(Wikidata.CONNECTIONS) as pool:
+            parts = pool.map(lambda q: cls.query(cls.config('endpoint'), q, ttl=ttl), queries)
+            result = {}
+            for part in parts:  # in order of queries, as if they were executed one by one
+                if part is None:
+                    return
+                for object_id, rows in part.items():
+                    result.setdefault(object_id, []).extend(rows)
         return result
 
     @classmethod
     def prepare_data(cls, external_id):
-        if external_id in cls._dataset:
+        if external_id in cls._dataset:  # references of the whole dataset are expected to be prefetched already
             rows = cls._dataset.pop(external_id)
-        elif external_id in (result := cls.load('main_id = \'{}\''.format(external_id))):
-            rows = result[external_id]
+        elif external_id in (result := cls.load('main_id = \'{}\''.format(external_id)) or {}):
+            AstroModel.prefetch_references(AstroModel.references(rows := result[external_id]))
         else:
             return
 
@@ -850,41 +1631,41 @@ class AstroModel(Model):
             return super().transform(property_id, value, lower, upper)
 
     @staticmethod
-    def query(url, adql, result=None):
-        if response := Wikidata.request(url + '/sync', data={'request': 'doQuery', 'lang': 'adql', 'format': 'csv',
-                                                             'maxrec': -1, 'query': adql}, stream=True):
-            with closing(response) as r:
-                reader = csv.reader(r.iter_lines(decode_unicode='utf-8'), delimiter=',', quotechar='"')
-                header = next(reader)
-                result = {} if result is None else result
-                for line in reader:
-                    if len(line) > 0:
-                        row = {}
-                        for i in range(1, len(line)):
-                            row[header[i]] = ' '.join(line[i].split()) if isinstance(line[i], str) else line[i]
-                        object_id = ' '.join(line[0].split())
-                        if object_id in result:
-                            result[object_id].append(row)
-                        else:
-                            result[object_id] = [row]
+    def query(url, adql, result=None, ttl: int = None):
+        if reader := Wikidata.csv(url + '/sync', ttl, data={'request': 'doQuery', 'lang': 'adql', 'format': 'csv',
+                                                            'maxrec': -1, 'query': adql}):
+            header = next(reader)
+            result = {} if result is None else result
+            for line in reader:
+                if len(line) > 0:
+                    row = {}
+                    for i in range(1, len(line)):
+                        row[header[i]] = ' '.join(line[i].split()) if isinstance(line[i], str) else line[i]
+                    object_id = ' '.join(line[0].split())
+                    if object_id in result:
+                        result[object_id].append(row)
+                    else:
+                        result[object_id] = [row]
         return result
 
     _parents, __PATTERN = None, 'https://www.wikidata.org/wiki/{}#P528\tcatalogue cache miss "{}"'
 
     @staticmethod
+    @Stats.timed('get_parent_snak')
     def get_parent_snak(name: str):
         if AstroModel._parents is None:
             AstroModel._parents = Wikidata.query('SELECT DISTINCT ?c ?i { ?i ^ps:P397 []; wdt:P528 ?c }',
-                                                 lambda row, _: (row[0].lower(), row[1]))
+                                                 lambda row, _: (row[0].lower(), row[1]),
+                                                 Model.config('ttl', 'parents'))
 
         name = name[:-1] if re.search('OGLE.+L$', name) else name  # In SIMBAD OGLE names are w/o trailing 'L'
+        Stats.hit('_parents', name.lower() in AstroModel._parents)
         if name.lower() not in AstroModel._parents:
             import simbad_dap
             if (simbad_id := simbad_dap.Model.get_id_by_name(name)) is None:
                 return
             if simbad_id.lower() not in AstroModel._parents:
-                (instance := simbad_dap.Model.get_by_id(simbad_id)).save()
-                if instance.qid is None:
+                if (instance := simbad_dap.Model.get_or_create(simbad_id)).qid is None:
                     return
                 AstroModel._parents[simbad_id.lower()] = instance.qid
             AstroModel._parents[name.lower()] = AstroModel._parents[simbad_id.lower()]
@@ -897,6 +1678,28 @@ class AstroModel(Model):
         return Wikidata.format_float(row[col], int(row[col + 'p']) if col + 'p' in row and row[col + 'p'] != '' else -1)
 
     @staticmethod
+    def references(rows):
+        """Urls of all references mentioned in rows"""
+        return (re.sub('.*(http\\S+).*', '\\g<1>', row[col]) for row in rows for col in row
+                if row[col] and (col == 'reference' or re.search('\\d+r$', col)))
+
+    @staticmethod
+    def prefetch_references(urls):
+        """Let arxiv.Model retrieve metadata of all preprints referenced by urls with a few batched requests, so that
+        subsequent parse_url() calls do not query ArXiv API one by one"""
+        import arxiv
+
+        preprints = set()
+        for url in set(urls):
+            if url and url.strip() and (url := url.split()[0]):
+                for pattern, repl in AstroModel.config('transform').items():
+                    if (query := unquote(re.sub(pattern, repl, url, flags=re.S))).startswith('P818='):
+                        preprints.add(query.replace('P818=', ''))
+        if preprints:
+            arxiv.Model.want(preprints)
+
+    @staticmethod
+    @Stats.timed('parse_url')
     def parse_url(url: str) -> str:
         """Try to find qid of the reference based on the url provided"""
         import ads
@@ -906,12 +1709,10 @@ class AstroModel(Model):
             for pattern, repl in AstroModel.config('transform').items():
                 if (query := unquote(re.sub(pattern, repl, url, flags=re.S))).startswith('P'):
                     if query.startswith('P818='):
-                        (instance := arxiv.Model.get_by_id(query.replace('P818=', ''))).save()
-                        if instance.qid:
+                        if (instance := arxiv.Model.get_or_create(query.replace('P818=', ''))).qid:
                             return instance.qid
                     elif query.startswith('P819='):
-                        (instance := ads.Model.get_by_id(query.replace('P819=', ''))).save()
-                        if instance.qid:
+                        if (instance := ads.Model.get_or_create(query.replace('P819=', ''))).qid:
                             return instance.qid
                     else:  # fallback
                         try:
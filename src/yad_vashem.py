@@ -61,14 +61,19 @@ class Model(wd.Model):
     API = 'https://yv360.yadvashem.org/api/'
 
     @classmethod
+    @wd.Stats.timed('next')
     def next(cls):
         wd.Wikidata.request(Model.API + 'Search/BuildGlobalResultsQuery?site=righteous&valueToSearch=2025', json={})
-        result, Model.__offset = [], Model.__offset + 1
+        result, Model.__offset = [], Model.checkpoint(Model.__offset) + 1
         url = Model.API + 'Search/GetDataResultsQuery?&pageSize=10&cardType=card&pageNumber=' + str(Model.__offset)
         payload = {"filters": {"filters": [{"fieldName": "data_bank", "values": ["righteous"]}]}, "currentTab": {}}
-        if response := wd.Wikidata.request(url, json=payload):
-            for card in response.json()['cards']:
-                result.append(card['id'])
+        if not (response := wd.Wikidata.request(url, json=payload)):  # checkpoint is kept to resume from this page
+            logging.error('Harvest interrupted at page {}'.format(Model.__offset))
+            return
+        for card in response.json()['cards']:
+            result.append(card['id'])
+        if not result:
+            Model.checkpoint(None)
         return result
 
     @staticmethod
@@ -150,7 +155,7 @@ if Model.initialize(__file__):  # if not imported
                 Model.get_by_id(name, forced=True).save()
 
     while ids := Model.next():
-        for _id in ids:
+        for _id in Model.pending(ids, prefetch=False):
             if (_id not in groups) and (wd_items := Model.extract(_id, {})):
                 Element.load(wd_items)
                 for name in wd_items: